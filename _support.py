@@ -8,7 +8,7 @@ import inspect
 from database import TicketDb
 import os
 
-tickets_db = TicketDb()
+tickets_db: TicketDb = None
 
 logger = logging.getLogger(__name__)
 
@@ -16,10 +16,11 @@ class _support:
 
     support_thread_id = int(os.getenv('SUPPORT_THREAD_ID'))
     support_group_id = int(os.getenv('SUPPORT_GROUP_ID'))
+    tickets_page_size = int(os.getenv('TICKETS_PAGE_SIZE', '5'))
 
     async def _open_support_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        active_tickets = tickets_db.get_all_tickets(query.from_user.id)
+        active_tickets = await tickets_db.get_all_tickets(query.from_user.id)
         active_tickets = [t for t in active_tickets if t[8] != 'answered']
         
         if active_tickets:
@@ -51,52 +52,68 @@ class _support:
         return states.WAITING_FOR_ACTION
     
     async def show_user_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Показывает тикеты пользователя"""
+        """
+        Показывает тикеты пользователя постранично.
+        Номер крайнего тикета страницы передаётся в callback_data кнопок: "my_tickets older 12" / "my_tickets newer 7"
+        """
         user = update.effective_user
         query = update.callback_query
-        
-        tickets = tickets_db.get_all_tickets(user.id)
+
+        before = after = None
+        if query and query.data.startswith("my_tickets "):
+            _, direction, cursor = query.data.split()
+            if direction == "older":
+                before = int(cursor)
+            else:
+                after = int(cursor)
+
+        tickets, has_more = await tickets_db.get_tickets_page(user.id, before, after, _support.tickets_page_size)
         if not tickets:
             message = "У вас пока нет созданных тикетов."
+            reply_markup = keyboards.main_menu()
         else:
             message = "📋 Ваши тикеты:\n\n"
-            for ticket in tickets:
-                status = "✅ Отвечено" if ticket[8] == 'answered' else "⏳ Ожидает ответа"
+            for _, ticket_id, description, phone, status, date, responses, attachments, last_response in tickets:
+                status = "✅ Отвечено" if status == 'answered' else "⏳ Ожидает ответа"
                 message += (
                     "--------------------\n"
-                    f"🆔 Тикет #{ticket[2]}\n"
-                    f"📝 Описание: \n{ticket[3]}\n"
-                    f"📱 Телефон: {ticket[7]}\n"
-                    f"📅 Дата: {ticket[9]}\n"
+                    f"🆔 Тикет #{ticket_id}\n"
+                    f"📝 Описание: \n{_support._shorten(description)}\n"
+                    f"📱 Телефон: {phone}\n"
+                    f"📅 Дата: {date}\n"
                     f"📊 Статус: {status}\n"
                 )
-                
-                # Получаем ответы на тикет
-                responses = tickets_db.get_ticket_responses(ticket[0])
                 if responses:
-                    message += "\n💬 Ответы:\n"
-                    for i, response in enumerate(responses, 1):
-                        message += f"{i}. {response[3]}\n"
-                        if response[4]:  # photo_id
-                            message += "   📷 Прикреплено фото\n"
-                        if response[5]:  # video_id
-                            message += "   🎥 Прикреплено видео\n"
-                        if response[6]:  # file_id
-                            message += "   📎 Прикреплен файл\n"
-                
+                    message += f"\n💬 Ответов: {responses}\n"
+                    if attachments:
+                        message += f"📎 Вложений: {attachments}\n"
+                    message += f"Последний ответ:\n{_support._shorten(last_response)}\n"
                 message += "\n"
-        
+
+            # Кнопка в сторону, откуда пришли, есть всегда; в сторону выборки - только если там ещё есть тикеты
+            newest, oldest = tickets[0][1], tickets[-1][1]
+            reply_markup = keyboards.tickets_page(
+                newer=newest if before is not None or (after is not None and has_more) else None,
+                older=oldest if after is not None or has_more else None
+            )
+
         if query:
-            await query.message.edit_text(message, reply_markup=keyboards.main_menu())
+            await query.message.edit_text(message, reply_markup=reply_markup)
         else:
-            await update.message.reply_text(message, reply_markup=keyboards.main_menu())
+            await update.message.reply_text(message, reply_markup=reply_markup)
+
+    def _shorten(text, limit=300):
+        """Обрезает длинный текст, чтобы страница тикетов укладывалась в лимит сообщения Telegram"""
+        if text and len(text) > limit:
+            return text[:limit].rstrip() + "…"
+        return text
     
     async def _create_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        active_tickets = tickets_db.get_all_tickets(query.from_user.id)
+        active_tickets = await tickets_db.get_all_tickets(query.from_user.id)
         active_tickets = [t for t in active_tickets if t[8] != 'answered']
         for ticket in active_tickets:
-            tickets_db.update_ticket_status(ticket[0], 'closed')
+            await tickets_db.update_ticket_status(ticket[0], 'closed')
 
         await query.message.edit_text(
             "📝 Создание тикета\n\n"
@@ -134,9 +151,9 @@ class _support:
         logger.info(f"Добавление телефона для пользователя {user.full_name} ({user.id})")
         
         # Обновляем тикет в базе данных
-        ticket = tickets_db.get_latest_ticket(user.id)
+        ticket = await tickets_db.get_latest_ticket(user.id)
         if ticket:
-            tickets_db.update_ticket_phone(ticket[0], phone)
+            await tickets_db.update_ticket_phone(ticket[0], phone)
             
             message = (
                 f"🆕 Новый тикет #{ticket[2]}\n\n"
@@ -196,7 +213,7 @@ class _support:
             logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при получении ID тикета")
             return states.WAITING_FOR_ACTION
         rating = int(query.data.split(' ')[1])
-        tickets_db.rate_ticket(ticket_id, rating)
+        await tickets_db.rate_ticket(ticket_id, rating)
         await query.message.edit_text(
             "✅ Спасибо за вашу оценку!\n\nВыберите действие:",
             reply_markup=keyboards.main_menu()
@@ -218,10 +235,8 @@ class _support:
             )
             return states.WAITING_FOR_TICKET_DESCRIPTION
         
-        ticket_id = len(tickets_db.get_all_tickets(user.id)) + 1
-        tickets_db.add_ticket(
+        await tickets_db.add_ticket(
             user_id=user.id,
-            ticket_id=ticket_id,
             description=description,
             photo_id=photo.file_id if photo else None,
             video_id=video.file_id if video else None,
@@ -1,64 +1,157 @@
 import keyboards
 import states
-import cv2
-import easyocr
+import ocr
 import states
 import keyboards
 import inspect
 import logging
 import os
-import re
-import numpy as np
+import asyncio
 from database import WarrantyDb
-from telegram import Update
+from telegram import Update, Message, PhotoSize
 from telegram.ext import ContextTypes
 from datetime import datetime, timedelta
 from database import PackedData as PacketData
 
 logger = logging.getLogger(__name__)
 
-warranty_db = WarrantyDb()
+warranty_db: WarrantyDb = None
 
 class ContextDataTypes:
     console_data = 'console_data'
     console_id = 'console_id'
 
+class DocumentTooLarge(Exception):
+    pass
+
 class _OCR:
-        
-    async def recognize(file, console_id):
 
-        photo_bytes = await file.download_as_bytearray()
-                
-        image = cv2.imdecode(
-            np.frombuffer(photo_bytes, np.uint8),
-            cv2.IMREAD_COLOR
-        )
-        processed_image = cv2.threshold(
-            cv2.GaussianBlur(
-                cv2.cvtColor(image, cv2.COLOR_BGR2GRAY),
-                (1, 1), 0
-            ),
-            100, 255, cv2.THRESH_BINARY
-        )[1]
-
-        reader = easyocr.Reader(['ru'])
-        recognized_text = " ".join(
-            reader.readtext(
-                processed_image,
-                allowlist ='0123456789',
-                detail=0,
-            )
-        )
-        
+    support_group_id = int(os.getenv('SUPPORT_GROUP_ID'))
+    support_thread_id = int(os.getenv('SUPPORT_THREAD_ID'))
+    min_photo_side = int(os.getenv('OCR_MIN_PHOTO_SIDE', '540'))
+    max_document_size = int(os.getenv('OCR_MAX_DOCUMENT_SIZE', str(10 * 1024 * 1024)))
+
+    def pick_photo_size(sizes: tuple[PhotoSize, ...]) -> PhotoSize:
+        """Наименьший из размеров фото, на котором цифры ещё уверенно распознаются"""
+        sizes = sorted(sizes, key=lambda size: size.width * size.height)
+        for size in sizes:
+            if min(size.width, size.height) >= _OCR.min_photo_side:
+                return size
+        return sizes[-1]
+
+    async def submit(photo, console_id):
+        """
+        Ставит скриншот в очередь на распознавание.
+        Повторно присланный файл берётся из кэша без скачивания и распознавания
+        :param photo: выбранный PhotoSize или Document с изображением
+        :return: позиция в очереди, future с распознанными строками и перцептивный хэш скриншота
+        :raises DocumentTooLarge: если документ больше OCR_MAX_DOCUMENT_SIZE
+        """
         if not console_id:
             raise ValueError("Не найдена информация о консоли в контексте")
 
-        warranty_id = warranty_db._get_warranty_id(console_id)
+        entry = ocr.cache.get(photo.file_unique_id)
+        if not entry:
+            if photo.file_size and photo.file_size > _OCR.max_document_size:
+                raise DocumentTooLarge()
+            file = await photo.get_file()
+            photo_bytes = await file.download_as_bytearray()
+            # Декодирование и первый импорт OpenCV выполняются вне цикла событий
+            phash = await asyncio.to_thread(ocr.cache.phash, photo_bytes)
+            position, job = ocr.pool.submit(
+                photo_bytes,
+                warranty_db._get_warranty_id(console_id),
+                getattr(photo, 'width', None)
+            )
+            return position, job, phash
 
-        if re.search(str(warranty_id.upper()), recognized_text):
-            return True
+        job = asyncio.get_running_loop().create_future()
+        job.set_result(entry.tokens)
+        return 0, job, entry.phash
+
+    async def recognize(job, console_id) -> ocr.Match:
+        """Нечётко сравнивает распознанные строки с кодом гарантии консоли"""
+        return ocr.matcher.match(await job, warranty_db._get_warranty_id(console_id))
+
+    async def request_manual_review(message: Message, photo, console_id, match: ocr.Match, reused_by=None):
+        """
+        Отправляет скриншот в топик поддержки, чтобы пользователь не застревал на повторных попытках
+        :param reused_by: консоли, гарантия которых уже подтверждена этим скриншотом
+        """
+        user = message.from_user
+        caption = (
+            "🔍 Скриншот отзыва требует ручной проверки\n\n"
+            f"👤 Пользователь: {user.first_name} (ID: {user.id})\n"
+            f"🎮 Консоль: <code>{console_id}</code>\n"
+            f"🔑 Код гарантии: <code>{warranty_db._get_warranty_id(console_id)}</code>\n"
+            f"🔎 Распознано: <code>{match.fragment}</code>\n"
+            f"📊 Оценка: {match.score:.2f}\n"
+        )
+        if reused_by:
+            caption += f"⚠️ Скриншот уже подтвердил гарантию консолей: {', '.join(f'<code>{console}</code>' for console in sorted(reused_by))}\n"
+        caption += f"\n✅ Одобрить: <code>/approve_warranty {console_id}</code>"
+        if isinstance(photo, PhotoSize):
+            await message.get_bot().send_photo(
+                chat_id=_OCR.support_group_id,
+                message_thread_id=_OCR.support_thread_id,
+                photo=photo.file_id,
+                caption=caption,
+                parse_mode='HTML'
+            )
         else:
-            return False
+            await message.get_bot().send_document(
+                chat_id=_OCR.support_group_id,
+                message_thread_id=_OCR.support_thread_id,
+                document=photo.file_id,
+                caption=caption,
+                parse_mode='HTML'
+            )
+
+    async def deliver(message: Message, job, console_id, phash, photo):
+        """Дожидается результата распознавания и отправляет его пользователю"""
+        try:
+            match = await _OCR.recognize(job, console_id)
+            logger.info(f"Проверка отзыва для консоли {console_id}: {match.verdict}, оценка {match.score:.2f}, расстояние {match.distance}")
+            approved = match.verdict == ocr.Verdict.APPROVED
+            entry, reused = ocr.cache.put(phash, job.result(), photo.file_unique_id, console_id if approved else None)
+            if reused:
+                logger.warning(f"Скриншот {phash:016x} для консоли {console_id} уже подтвердил гарантию консолей: {', '.join(sorted(entry.consoles))}")
+                await _OCR.request_manual_review(message, photo, console_id, match, entry.consoles)
+                await message.reply_text(
+                    "🔍 Этот скриншот уже использовался для подтверждения гарантии других консолей, "
+                    "поэтому мы передали его на проверку в поддержку.\n"
+                    "Мы пришлём уведомление, как только гарантия будет подтверждена.",
+                    reply_markup=keyboards.warranty()
+                )
+            elif approved:
+                await warranty_db.approve_warranty(console_id)
+                await message.reply_text(
+                    "🎉 Поздравляем! У вас теперь расширенная гарантия!\n\n"
+                    "Теперь вы можете пользоваться всеми преимуществами в течение 548 дней:\n"
+                    "✅ Организация доставки в сервисный центр за наш счет\n"
+                    "✅ Бесплатный ремонт\n"
+                    "✅ Быстрая замена при необходимости\n\n"
+                    "Проверить статус гарантии можно в меню гарантии.",
+                    reply_markup=keyboards.warranty()
+                )
+            elif match.verdict == ocr.Verdict.MANUAL:
+                await _OCR.request_manual_review(message, photo, console_id, match)
+                await message.reply_text(
+                    "🔍 Код на скриншоте распознан не полностью, поэтому мы передали скриншот на проверку в поддержку.\n"
+                    "Мы пришлём уведомление, как только гарантия будет подтверждена.",
+                    reply_markup=keyboards.warranty()
+                )
+            else:
+                await message.reply_text(
+                    '❌ Не удалось распознать код. Попробуйте обрезать скриншот для лучшего распознования.',
+                    reply_markup=keyboards.warranty()
+                )
+        except Exception as e:
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка обработки отзыва: {e}")
+            await message.reply_text(
+                "⚠️ Произошла ошибка при обработке. Пожалуйста, попробуйте позже или обратитесь в поддержку.",
+                reply_markup=keyboards.warranty()
+            )
 
 class _warranty:
 
@@ -85,16 +178,14 @@ class _warranty:
         return states.WAITING_FOR_ACTION
 
     async def _check_remainig(data: PacketData):
-        registration_date = datetime.strptime(data.approval_date, '%d-%m-%Y')
-        warranty_end = registration_date + timedelta(days=_warranty.warranty_duration + _warranty.delivery_compensation)
-        remaining_days = (warranty_end - datetime.now()).days
+        # Дата окончания гарантии считается в базе при подтверждении, см. WarrantyDb.approve_warranty
+        remaining_days = (data.warranty_expires - datetime.now().date()).days
         return remaining_days
         
     
     async def _check_bind_period(data: PacketData):
-        sell_date = datetime.strptime(data.sell_date, '%d-%m-%Y')
-        period_end = sell_date + timedelta(days=_warranty.warranty_bind_period)
-        remaining_days = (period_end - datetime.now()).days
+        period_end = data.sell_date + timedelta(days=_warranty.warranty_bind_period)
+        remaining_days = (period_end - datetime.now().date()).days
         if remaining_days <= 0:
             return False
         else:
@@ -131,27 +222,31 @@ class _warranty:
             return states.WAITING_FOR_PHOTO_CHECK
         
         try:
-            file = await message.photo[-1].get_file() if message.photo else message.document
+            photo = _OCR.pick_photo_size(message.photo) if message.photo else message.document
             console: PacketData = context.user_data.pop(ContextDataTypes.console_data, None)
             console_id = console.console_id
-            if await _OCR.recognize(file, console_id):
-                warranty_db.approve_warranty(console_id)
+            try:
+                position, job, phash = await _OCR.submit(photo, console_id)
+            except DocumentTooLarge:
+                context.user_data[ContextDataTypes.console_data] = console
                 await message.reply_text(
-                    "🎉 Поздравляем! У вас теперь расширенная гарантия!\n\n"
-                    "Теперь вы можете пользоваться всеми преимуществами в течение 548 дней:\n"
-                    "✅ Организация доставки в сервисный центр за наш счет\n"
-                    "✅ Бесплатный ремонт\n"
-                    "✅ Быстрая замена при необходимости\n\n"
-                    "Проверить статус гарантии можно в меню гарантии.",
-                    reply_markup=keyboards.warranty()
+                    "❌ Файл слишком большой. Пожалуйста, отправьте скриншот как фото или обрежьте его.",
+                    reply_markup=keyboards.back_to_main_menu()
                 )
-                return states.WAITING_FOR_ACTION
-            else:
+                return states.WAITING_FOR_PHOTO_CHECK
+            except ocr.OcrQueueFull:
+                context.user_data[ContextDataTypes.console_data] = console
                 await message.reply_text(
-                    '❌ Не удалось распознать код. Попробуйте обрезать скриншот для лучшего распознования.',
-                    reply_markup=keyboards.warranty()
+                    "⏳ Сейчас проверяется слишком много скриншотов. Пожалуйста, отправьте скриншот ещё раз через пару минут.",
+                    reply_markup=keyboards.back_to_main_menu()
                 )
-                return states.WAITING_FOR_ACTION
+                return states.WAITING_FOR_PHOTO_CHECK
+
+            if position:
+                await message.reply_text(f"⏳ Скриншот поставлен в очередь на проверку, позиция {position}. Мы пришлём результат, как только он будет готов.")
+            elif not job.done():
+                await message.reply_text("⏳ Проверяем скриншот, это займёт немного времени...")
+            context.application.create_task(_OCR.deliver(message, job, console_id, phash, photo), update=update)
         except Exception as e:
             logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка обработки отзыва: {e}")
             await message.reply_text(
@@ -175,7 +270,7 @@ class _warranty:
         try:
             console_id = update.message.text
             user_id = update.message.chat_id
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             
             if not await console.exist():
                 await update.message.reply_text(
@@ -219,8 +314,8 @@ class _warranty:
                                 reply_markup=keyboards.back_to_main_menu()
                             )
                             return states.WAITING_FOR_ACTION
-                        if warranty_db.bind_warranty(console_id, user_id):
-                            console = warranty_db.get_packed(console_id)
+                        if await warranty_db.bind_warranty(console_id, user_id):
+                            console = await warranty_db.get_packed(console_id)
                             await update.message.reply_text(
                                 "➖ Ваша гарантия не подтверждена.\n"
                                 f"Ваш код гарантии {console.warranty_id}.\n"
@@ -1,7 +1,12 @@
+import time
+started = time.perf_counter()
+
 import os
 import logging
 import sys
 import inspect
+import asyncio
+import subprocess
 from dotenv import load_dotenv
 from telegram import  Update
 from telegram.ext import (
@@ -9,6 +14,7 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ConversationHandler,
     filters
 )
@@ -40,6 +46,11 @@ import states
 import telegram
 import managers
 import media_handler
+import ocr
+import database
+import broadcast
+import _support
+import _warranty
 
 class Main:
     def __init__(self):
@@ -51,11 +62,17 @@ class Main:
                 logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nТокен бота не найден в файле .env")
                 return
 
-            self.application = Application.builder().token(token).build()
+            self.application = Application.builder().token(token).post_init(Main._post_init).post_stop(Main._stop).post_shutdown(Main._shutdown).build()
             
             self.media_handler = media_handler.MediaManager(self.application.bot)
 
             managers.media_manager = self.media_handler
+
+            # Одна пара объектов баз на весь бот: у каждого файла базы один менеджер соединений
+            self.tickets_db = database.TicketDb()
+            self.warranty_db = database.WarrantyDb()
+            managers.tickets_db = _support.tickets_db = self.tickets_db
+            managers.warranty_db = _warranty.warranty_db = self.warranty_db
             
             conv_handler = ConversationHandler(
                 entry_points=[CommandHandler('start', managers.UserConversation.start, filters=filters.ChatType.PRIVATE), CallbackQueryHandler(managers.UserConversation.button_handler)],
@@ -84,7 +101,7 @@ class Main:
                     ],
                     states.WAITING_FOR_PHOTO_CHECK: [
                         MessageHandler(
-                            filters.PHOTO, managers.UserConversation.Warranty.check_review_photo
+                            filters.PHOTO | filters.Document.IMAGE, managers.UserConversation.Warranty.check_review_photo
                         ),
                         CallbackQueryHandler(managers.UserConversation.button_handler)
                     ]
@@ -94,6 +111,9 @@ class Main:
             )
             
             self.application.add_handler(conv_handler)
+
+            self.application.add_handler(ChatMemberHandler(
+                managers.UserConversation.track_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
             
             self.application.add_handler(MessageHandler(
                 filters.Regex(r'(?i)^/id$') & filters.Chat(SUPPORT_GROUP_ID), 
@@ -107,10 +127,18 @@ class Main:
                 filters.Regex(r'(?i)^'+Format.console_code+r'$') & ~filters.COMMAND & filters.Chat(SUPPORT_GROUP_ID), 
                 managers.ConsoleCodes.add_console_code))
 
+            self.application.add_handler(MessageHandler(
+                (filters.Document.FileExtension('csv') | filters.Document.FileExtension('xlsx') | filters.Document.FileExtension('txt')) & ~filters.CaptionRegex(r'^/') & filters.Chat(SUPPORT_GROUP_ID),
+                managers.ConsoleCodes.import_codes))
+
             self.application.add_handler(MessageHandler(
                 filters.Regex(r'(?i)^/data '+Format.console_code+r'$') & filters.Chat(SUPPORT_GROUP_ID), 
                 managers.ConsoleCodes.get_data))
             
+            self.application.add_handler(MessageHandler(
+                filters.Regex(r'(?i)^/expiring( \d+)?$') & filters.Chat(SUPPORT_GROUP_ID),
+                managers.ConsoleCodes.expiring))
+
             self.application.add_handler(MessageHandler(
                 filters.Regex(r'(?i)^/remove '+Format.console_code+r'$') & filters.Chat(int(SUPPORT_GROUP_ID)), 
                 managers.ConsoleCodes.remove_console))
@@ -143,6 +171,18 @@ class Main:
                 (filters.Regex(r'(?i)^/newsletter\s+.+') | filters.CaptionRegex(r'(?i)^/newsletter\s+.+')) & filters.Chat(SUPPORT_GROUP_ID),
                 managers.SupportManager.newsletter))
             
+            self.application.add_handler(MessageHandler(
+                filters.Regex(r'(?i)^/newsletter_(pause|resume|cancel) \d+$') & filters.Chat(SUPPORT_GROUP_ID),
+                managers.SupportManager.newsletter_control))
+
+            self.application.add_handler(MessageHandler(
+                filters.Regex(r'(?i)^/newsletters$') & filters.Chat(SUPPORT_GROUP_ID),
+                managers.SupportManager.newsletters))
+
+            self.application.add_handler(MessageHandler(
+                filters.Regex(r'(?i)^/export(\s+\w+)*$') & filters.Chat(SUPPORT_GROUP_ID),
+                managers.SupportManager.export))
+
             self.application.add_handler(MessageHandler(
                 filters.Regex(r'(?i)^/approve_warranty '+Format.console_code+r'$') & filters.Chat(SUPPORT_GROUP_ID),
                 managers.SupportManager.manual_warranty_approval))
@@ -160,6 +200,60 @@ class Main:
         except telegram.error.Conflict:
             logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОбнаружен конфликт: возможно, запущено несколько экземпляров бота")
             sys.exit(1)
-        
+
+    async def _post_init(application: Application):
+        logger.info(f"Бот запущен за {time.perf_counter() - started:.2f} с")
+        await broadcast.jobs.start(application, managers.tickets_db)
+        if os.getenv('OCR_PRELOAD', '0') == '1':
+            application.create_task(Main._warm_up_ocr())
+
+    async def _warm_up_ocr():
+        """Фоновая загрузка стека OCR после старта, чтобы не задерживать запуск бота"""
+        try:
+            await asyncio.to_thread(ocr.load_stack)
+            ocr.pool.warm_up()
+            logger.info("Запущен прогрев OCR")
+        except Exception as e:
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при прогреве OCR: {e}")
+
+    async def _stop(application: Application):
+        # Рассылки останавливаются до закрытия HTTP-клиента бота, чтобы начатые отправки завершились
+        await broadcast.jobs.shutdown()
+
+    async def _shutdown(application: Application):
+        ocr.pool.shutdown()
+        logger.info(f"Кэш гарантий: {managers.warranty_db.cache_stats()}")
+        managers.tickets_db._close()
+        managers.warranty_db._close()
+        ocr.cache.close()
+
+    def import_time_report(top=15):
+        """
+        Отчёт о времени импорта модулей по данным python -X importtime.
+        Отдельно замеряются модули бота и стек OCR, который загружается только при проверке скриншотов
+        """
+        stages = (
+            ("Модули бота", "import managers, media_handler, ocr"),
+            ("Стек OCR", "import ocr; ocr.load_stack(); import easyocr"),
+        )
+        for title, code in stages:
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+            modules = []
+            for line in result.stderr.splitlines():
+                if not line.startswith('import time:'):
+                    continue
+                _, cumulative, name = line[len('import time:'):].split('|')
+                if not cumulative.strip().isdigit() or name.startswith('  '):
+                    continue
+                modules.append((int(cumulative), name.strip()))
+            total = sum(cumulative for cumulative, _ in modules)
+            report = "\n".join(f"{cumulative / 1000:>10.1f} мс  {name}" for cumulative, name in sorted(modules, reverse=True)[:top])
+            logger.info(f"{title}: импорт занял {total / 1000:.1f} мс\n{report}")
+            if result.returncode:
+                logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка импорта ({title}): {result.stderr.splitlines()[-1]}")
+
 if __name__ == '__main__':
-    Main()
\ No newline at end of file
+    if '--importtime' in sys.argv:
+        Main.import_time_report()
+    else:
+        Main()
\ No newline at end of file
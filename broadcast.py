@@ -0,0 +1,398 @@
+"""
+Рассылка сообщений пользователям бота.
+Одновременно выполняется не больше BROADCAST_CONCURRENCY отправок, а скорость ограничена лимитами Telegram:
+общий token bucket на BROADCAST_RATE сообщений в секунду и не чаще одного сообщения в BROADCAST_CHAT_INTERVAL секунд
+в один чат. При RetryAfter отправка приостанавливается для всех на указанное время, а сообщение отправляется повторно
+"""
+import os
+import time
+import asyncio
+import logging
+import inspect
+from datetime import timedelta
+from telegram import Bot
+from telegram.error import TelegramError, RetryAfter, BadRequest, Forbidden, TimedOut, NetworkError
+
+logger = logging.getLogger(__name__)
+
+
+class Payload:
+    """Содержимое рассылки: текст и, при необходимости, одно вложение по file_id"""
+    kinds = ('text', 'photo', 'video', 'document')
+
+    def __init__(self, kind, text, file_id=None):
+        if kind not in self.kinds:
+            raise ValueError(f"Неизвестный тип рассылки: {kind}")
+        self.kind = kind
+        self.text = text
+        self.file_id = file_id
+
+    async def send(self, bot: Bot, chat_id):
+        if self.kind == 'photo':
+            await bot.send_photo(chat_id=chat_id, photo=self.file_id, caption=self.text)
+        elif self.kind == 'video':
+            await bot.send_video(chat_id=chat_id, video=self.file_id, caption=self.text)
+        elif self.kind == 'document':
+            await bot.send_document(chat_id=chat_id, document=self.file_id, caption=self.text)
+        else:
+            await bot.send_message(chat_id=chat_id, text=self.text)
+
+
+class RateLimiter:
+    """
+    Ограничитель скорости отправки, общий для всех рассылок бота.
+    Глобальный лимит - token bucket с небольшим запасом BROADCAST_BURST сообщений, лимит на чат - минимальный интервал
+    между сообщениями
+    """
+
+    def __init__(self, rate=None, chat_interval=None, burst=None):
+        self.rate = rate or float(os.getenv('BROADCAST_RATE', '30'))
+        self.chat_interval = chat_interval if chat_interval is not None else float(os.getenv('BROADCAST_CHAT_INTERVAL', '1'))
+        self.capacity = burst or float(os.getenv('BROADCAST_BURST', '5'))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._chats = {}
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, chat_id):
+        """Ждёт, пока в чат chat_id можно будет отправить сообщение"""
+        # Время следующей отправки в чат резервируется сразу, чтобы параллельные отправки в один чат шли по очереди
+        now = time.monotonic()
+        slot = max(now, self._chats.get(chat_id, 0) + self.chat_interval)
+        self._chats[chat_id] = slot
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+        if len(self._chats) > 10000:
+            expired = time.monotonic() - self.chat_interval
+            self._chats = {chat: slot for chat, slot in self._chats.items() if slot > expired}
+
+    def pause(self, seconds):
+        """Приостанавливает все отправки на seconds секунд (ответ RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+limiter = RateLimiter()
+
+
+def _retry_after(error: RetryAfter):
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return error.retry_after
+
+
+def unreachable(error):
+    """Пользователь заблокировал бота, удалил аккаунт или чат не существует - повторять отправку бесполезно"""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in error.message.lower()
+
+
+async def _iterate(recipients):
+    if hasattr(recipients, '__aiter__'):
+        async for chat_id in recipients:
+            yield chat_id
+    else:
+        for chat_id in recipients:
+            yield chat_id
+
+
+class Broadcast:
+    """
+    Одна рассылка payload по списку получателей. Получатели могут быть обычным или асинхронным итератором,
+    они читаются по мере отправки. Счётчики sent/failed доступны во время работы.
+    on_result(chat_id, error) вызывается после каждой попытки доставки, error - None при успехе
+    """
+
+    def __init__(self, bot: Bot, payload: Payload, recipients, concurrency=None, retries=None, on_result=None):
+        self.bot = bot
+        self.payload = payload
+        self.recipients = recipients
+        self.concurrency = concurrency or int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+        self.retries = retries if retries is not None else int(os.getenv('BROADCAST_RETRIES', '3'))
+        self.on_result = on_result
+        self.sent = 0
+        self.failed = 0
+        self.stopped = False
+
+    def stop(self):
+        """Останавливает рассылку: уже начатые отправки завершаются, остальные получатели не обрабатываются"""
+        self.stopped = True
+
+    async def run(self):
+        queue = asyncio.Queue(self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            async for chat_id in _iterate(self.recipients):
+                if self.stopped:
+                    break
+                await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        return self
+
+    async def _worker(self, queue: asyncio.Queue):
+        while (chat_id := await queue.get()) is not None:
+            if not self.stopped:
+                await self._deliver(chat_id)
+
+    async def _deliver(self, chat_id):
+        """Повторы после RetryAfter не ограничены, retries расходуется только на сетевые ошибки"""
+        attempt = 0
+        while True:
+            await limiter.acquire(chat_id)
+            try:
+                await self.payload.send(self.bot, chat_id)
+                self.sent += 1
+                if self.on_result:
+                    self.on_result(chat_id, None)
+                return
+            except RetryAfter as e:
+                # Сообщение возвращается в очередь этого обработчика и уйдёт после паузы
+                logger.warning(f"Telegram ограничил частоту отправки, пауза {_retry_after(e)} с")
+                limiter.pause(_retry_after(e))
+            except BadRequest as e:
+                # BadRequest наследуется от NetworkError, но повтор не поможет
+                error = e
+                break
+            except (TimedOut, NetworkError) as e:
+                error = e
+                if attempt >= self.retries:
+                    break
+                await asyncio.sleep(2 ** attempt)
+                attempt += 1
+            except TelegramError as e:
+                error = e
+                break
+        logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при отправке рассылки пользователю {chat_id}: {error}")
+        self.failed += 1
+        if self.on_result:
+            self.on_result(chat_id, error)
+
+
+class Progress:
+    """
+    Сообщение о ходе рассылки в топике, из которого она запущена. Редактируется не чаще раза
+    в BROADCAST_PROGRESS_SECONDS секунд и только если текст изменился. Все значения берутся
+    из счётчиков Broadcast в памяти, запросов к базе для обновления нет
+    """
+
+    def __init__(self, bot: Bot, chat_id, thread_id, broadcast_id, job: Broadcast, sent, failed, pending, interval=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.thread_id = thread_id
+        self.broadcast_id = broadcast_id
+        self.job = job
+        # Результаты прошлых запусков задания, если оно продолжается после паузы или перезапуска
+        self.sent = sent
+        self.failed = failed
+        self.pending = pending
+        self.interval = interval or float(os.getenv('BROADCAST_PROGRESS_SECONDS', '5'))
+        self.started = time.monotonic()
+        self.message = None
+        self._text = None
+
+    def render(self, status=None):
+        done = self.job.sent + self.job.failed
+        remaining = max(0, self.pending - done)
+        elapsed = time.monotonic() - self.started
+        rate = done / elapsed if elapsed > 0 else 0
+        text = (
+            f"📨 Рассылка #{self.broadcast_id}: {status or 'идёт'}\n"
+            f"✅ Отправлено: {self.sent + self.job.sent}\n"
+            f"❌ Не доставлено: {self.failed + self.job.failed}\n"
+            f"⏳ Осталось: {remaining}\n"
+            f"⚡️ Скорость: {rate:.1f} сообщ./с"
+        )
+        if not status and remaining:
+            text += f"\n🕒 Осталось времени: {timedelta(seconds=round(remaining / rate)) if rate else 'оценивается'}"
+        return text
+
+    async def run(self):
+        while True:
+            await self.update()
+            await asyncio.sleep(self.interval)
+
+    async def update(self, status=None):
+        text = self.render(status)
+        if text == self._text:
+            return
+        try:
+            # Правки сообщения тоже расходуют общий лимит Telegram
+            await limiter.acquire(self.chat_id)
+            if self.message is None:
+                self.message = await self.bot.send_message(chat_id=self.chat_id, message_thread_id=self.thread_id, text=text)
+            else:
+                await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message.message_id, text=text)
+            self._text = text
+        except TelegramError as e:
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при обновлении хода рассылки #{self.broadcast_id}: {e}")
+
+
+class BroadcastJobs:
+    """
+    Задания рассылки, сохранённые в базе тикетов (см. TicketDb.create_broadcast).
+    Каждое задание выполняется в фоновой задаче, результаты отправки сохраняются пачками по BROADCAST_CHECKPOINT
+    получателей или раз в BROADCAST_CHECKPOINT_SECONDS секунд. После перезапуска бота незавершённые задания
+    продолжаются с получателей, которым сообщение ещё не отправлено.
+    При аварийной остановке повторно могут уйти только сообщения из последней несохранённой пачки
+    """
+
+    def __init__(self, checkpoint_size=None, checkpoint_interval=None):
+        self.checkpoint_size = checkpoint_size or int(os.getenv('BROADCAST_CHECKPOINT', '100'))
+        self.checkpoint_interval = checkpoint_interval or float(os.getenv('BROADCAST_CHECKPOINT_SECONDS', '2'))
+        self.db = None
+        self.application = None
+        self.running: dict[int, Broadcast] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    async def start(self, application, db):
+        """Подключает базу и продолжает задания, прерванные остановкой бота"""
+        self.application = application
+        self.db = db
+        for job in await self.db.get_broadcasts(("running",)):
+            logger.info(f"Продолжается рассылка #{job[0]}")
+            self._launch(job[0])
+
+    async def create(self, payload: Payload, chat_id, thread_id, audience=None):
+        """:return: id задания и количество получателей"""
+        broadcast_id, recipients = await self.db.create_broadcast(payload.kind, payload.text, payload.file_id, chat_id, thread_id, audience)
+        self._launch(broadcast_id)
+        return broadcast_id, recipients
+
+    async def pause(self, broadcast_id):
+        return await self._stop(broadcast_id, "paused")
+
+    async def cancel(self, broadcast_id):
+        return await self._stop(broadcast_id, "cancelled")
+
+    async def resume(self, broadcast_id):
+        job = await self.db.get_broadcast(broadcast_id)
+        if not job or job[5] != "paused":
+            return False
+        await self.db.set_broadcast_status(broadcast_id, "running")
+        self._launch(broadcast_id)
+        return True
+
+    async def _stop(self, broadcast_id, status):
+        job = await self.db.get_broadcast(broadcast_id)
+        if not job or job[5] not in ("running", "paused"):
+            return False
+        await self.db.set_broadcast_status(broadcast_id, status)
+        if broadcast_id in self.running:
+            self.running[broadcast_id].stop()
+        if broadcast_id in self._tasks:
+            # Ждём сохранения результатов уже начатых отправок
+            await self._tasks[broadcast_id]
+        return True
+
+    async def shutdown(self):
+        """Останавливает рассылки без смены статуса, чтобы они продолжились после запуска"""
+        for job in self.running.values():
+            job.stop()
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _launch(self, broadcast_id):
+        if broadcast_id in self._tasks and not self._tasks[broadcast_id].done():
+            return
+        # Не application.create_task: такие задачи Application.stop ждёт до конца, а рассылка может идти часами
+        task = asyncio.get_running_loop().create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda done: self._finished(broadcast_id, done))
+
+    def _finished(self, broadcast_id, task: asyncio.Task):
+        if self._tasks.get(broadcast_id) is task:
+            del self._tasks[broadcast_id]
+        if not task.cancelled() and task.exception():
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка в рассылке #{broadcast_id}: {task.exception()}")
+
+    async def _recipients(self, broadcast_id):
+        after = -1 << 63
+        while chunk := await self.db.get_pending_recipients(broadcast_id, after):
+            for user_id in chunk:
+                yield user_id
+            after = chunk[-1]
+
+    async def _run(self, broadcast_id):
+        _, kind, text, file_id, _, status, chat_id, thread_id, _ = await self.db.get_broadcast(broadcast_id)
+        if status != "running":
+            return
+        sent, failed, inactive = [], [], []
+        checkpoint = time.monotonic()
+        pending_writes = set()
+
+        def save():
+            nonlocal sent, failed, inactive, checkpoint
+            writes = [self.db.mark_recipients(broadcast_id, sent, failed)]
+            if inactive:
+                writes.append(self.db.set_users_active(inactive, False))
+            for write in writes:
+                write = asyncio.create_task(write)
+                pending_writes.add(write)
+                write.add_done_callback(pending_writes.discard)
+            sent, failed, inactive, checkpoint = [], [], [], time.monotonic()
+
+        def on_result(user_id, error):
+            (failed if error else sent).append(user_id)
+            if error and unreachable(error):
+                inactive.append(user_id)
+            if len(sent) + len(failed) >= self.checkpoint_size or time.monotonic() - checkpoint >= self.checkpoint_interval:
+                save()
+
+        job = Broadcast(self.application.bot, Payload(kind, text, file_id), self._recipients(broadcast_id), on_result=on_result)
+        self.running[broadcast_id] = job
+        progress = Progress(self.application.bot, chat_id, thread_id, broadcast_id, job, *await self._counts(broadcast_id))
+        progress_task = asyncio.create_task(progress.run())
+        try:
+            await job.run()
+        finally:
+            del self.running[broadcast_id]
+            progress_task.cancel()
+            save()
+            await asyncio.gather(*pending_writes)
+
+        if job.stopped:
+            status = (await self.db.get_broadcast(broadcast_id))[5]
+            await progress.update({"paused": "на паузе", "cancelled": "отменена"}.get(status, "остановлена"))
+            return
+        await self.db.set_broadcast_status(broadcast_id, "done")
+        await progress.update("завершена")
+        _, total_sent, total_failed = await self.db.get_broadcast_counts(broadcast_id)
+        try:
+            await self.application.bot.send_message(
+                chat_id=chat_id,
+                message_thread_id=thread_id,
+                text=f"📊 Результаты рассылки #{broadcast_id}:\n"
+                     f"✅ Успешно отправлено: {total_sent}\n"
+                     f"❌ Не удалось отправить: {total_failed}"
+            )
+        except TelegramError as e:
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при отправке отчёта о рассылке #{broadcast_id}: {e}")
+
+    async def _counts(self, broadcast_id):
+        """:return: отправлено и не доставлено в прошлых запусках, ожидает отправки"""
+        pending, sent, failed = await self.db.get_broadcast_counts(broadcast_id)
+        return sent, failed, pending
+
+
+jobs = BroadcastJobs()
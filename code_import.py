@@ -0,0 +1,102 @@
+"""
+Разбор файлов с кодами консолей для массового добавления в базу гарантий.
+Поддерживаются CSV, XLSX и текстовые файлы: в каждой строке код консоли и, при необходимости, дата продажи.
+Файл читается построчно, поэтому память не зависит от размера партии
+"""
+import re
+import csv
+import datetime
+from re_codes import Format
+
+extensions = ('csv', 'xlsx', 'txt')
+
+
+class ImportReport:
+    """Итоги импорта: сколько строк добавлено, пропущено (консоль уже есть в базе) и отклонено"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.invalid_lines = []
+
+    def reject(self, line_number):
+        self.invalid += 1
+        if len(self.invalid_lines) < 10:
+            self.invalid_lines.append(line_number)
+
+
+def _read_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        # Excel в русской локали сохраняет CSV через ";", поэтому разделитель определяется по первой строке
+        first_line = f.readline()
+        delimiter = max(',;\t', key=first_line.count)
+        f.seek(0)
+        yield from csv.reader(f, delimiter=delimiter)
+
+
+def _read_txt(path):
+    with open(path, encoding='utf-8-sig') as f:
+        for line in f:
+            yield re.split(r'[\s,;]+', line.strip())
+
+
+def _read_xlsx(path):
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportError("Для импорта XLSX установите пакет openpyxl")
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+readers = {
+    'csv': _read_csv,
+    'txt': _read_txt,
+    'xlsx': _read_xlsx,
+}
+
+
+def _parse_date(value):
+    if value is None or value == '':
+        return datetime.date.today().strftime(Format.date)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime(Format.date)
+    value = str(value).strip()
+    if not re.fullmatch(Format.date_raw, value):
+        raise ValueError(value)
+    datetime.datetime.strptime(value, Format.date)
+    return value
+
+
+def parse(path, extension, report: ImportReport, chunk_size=1000):
+    """
+    Построчно разбирает файл и отдаёт пачки по chunk_size пар (код консоли, дата продажи).
+    Если дата не указана, консоль считается проданной сегодня, как при добавлении одного кода.
+    Первая строка без цифр считается заголовком. Некорректные строки учитываются в report
+    """
+    chunk = []
+    for line_number, row in enumerate(readers[extension](path), 1):
+        cells = [cell for cell in row if cell is not None and str(cell).strip() != '']
+        if not cells:
+            continue
+        code = str(cells[0]).strip().upper()
+        if not re.fullmatch(Format.console_code, code):
+            if line_number == 1 and not re.search(r'\d', code):
+                continue
+            report.reject(line_number)
+            continue
+        try:
+            date = _parse_date(cells[1] if len(cells) > 1 else None)
+        except ValueError:
+            report.reject(line_number)
+            continue
+        chunk.append((code, date))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
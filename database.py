@@ -3,19 +3,344 @@ import logging
 import datetime
 import inspect
 import re
+import os
+import csv
+import json
+import gzip
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+EPOCH = datetime.date(1970, 1, 1)
+
+class SqliteExecutor:
+    """
+    Менеджер соединений с файлом базы SQLite. На каждый файл создаётся один экземпляр (см. shared).
+    Запросы выполняются вне цикла событий бота: запись идёт последовательно через отдельный поток,
+    чтение - параллельно через пул потоков. У каждого потока своё соединение с одинаковыми настройками PRAGMA.
+    Записи, пришедшие почти одновременно (до DB_WRITE_BATCH штук или DB_WRITE_WINDOW_MS миллисекунд ожидания),
+    фиксируются одной транзакцией, чтобы при потоке /start не платить за fsync на каждую запись
+    """
+    pragmas = {
+        'synchronous': 'NORMAL',
+        'cache_size': os.getenv('DB_CACHE_SIZE', '-16000'),
+        'mmap_size': os.getenv('DB_MMAP_SIZE', '268435456'),
+        'temp_store': 'MEMORY',
+        'busy_timeout': os.getenv('DB_BUSY_TIMEOUT', '5000'),
+    }
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, db_name, attach=None):
+        """Возвращает общий менеджер для файла базы, создавая его при первом обращении"""
+        key = os.path.abspath(db_name)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(db_name, attach=attach)
+            return cls._instances[key]
+
+    def __init__(self, db_name, readers=None, batch_size=None, batch_window=None, attach=None):
+        self.db_name = db_name
+        # Базы, подключаемые к каждому соединению через ATTACH для запросов между файлами: {псевдоним: путь}
+        self.attach = attach or {}
+        self.readers = readers or int(os.getenv('DB_READERS', '4'))
+        self.batch_size = batch_size or int(os.getenv('DB_WRITE_BATCH', '100'))
+        self.batch_window = batch_window if batch_window is not None else int(os.getenv('DB_WRITE_WINDOW_MS', '10')) / 1000
+        self._batch = []
+        self._flush_handle = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        name = os.path.basename(db_name)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{name}-writer', initializer=self._connect)
+        self._reader = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix=f'{name}-reader', initializer=self._connect)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False)
+        # Режим журнала хранится в самом файле базы, повторная установка ничего не стоит
+        conn.execute('PRAGMA journal_mode=WAL')
+        for pragma, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {pragma}={value}')
+        for alias, path in self.attach.items():
+            conn.execute(f'ATTACH DATABASE ? AS {alias}', (path,))
+        self._local.conn = conn
+        with self._lock:
+            self._connections.append(conn)
+
+    def _read(self, func, args):
+        cursor = self._local.conn.cursor()
+        try:
+            return func(cursor, *args)
+        finally:
+            cursor.close()
+
+    def _write(self, func, args):
+        conn = self._local.conn
+        cursor = conn.cursor()
+        try:
+            result = func(cursor, *args)
+            conn.commit()
+            return result
+        except:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def _write_batch(self, batch):
+        """
+        Выполняет пакет записей одной транзакцией. Каждая запись идёт в своей точке сохранения,
+        поэтому ошибка одной записи не отменяет остальные
+        :return: список пар (результат, исключение) в порядке пакета
+        """
+        conn = self._local.conn
+        cursor = conn.cursor()
+        results = []
+        try:
+            cursor.execute('BEGIN')
+            for func, args in batch:
+                cursor.execute('SAVEPOINT write')
+                try:
+                    results.append((func(cursor, *args), None))
+                    cursor.execute('RELEASE write')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write')
+                    cursor.execute('RELEASE write')
+                    results.append((None, e))
+            conn.commit()
+            return results
+        except:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    async def read(self, func, *args):
+        """Выполняет func(cursor, *args) в потоке чтения"""
+        return await asyncio.get_running_loop().run_in_executor(self._reader, self._read, func, args)
+
+    async def write(self, func, *args):
+        """
+        Ставит func(cursor, *args) в очередь записи и ждёт фиксации транзакции
+        :return: результат func
+        """
+        return await self._enqueue(func, args)
+
+    def write_later(self, func, *args):
+        """Запись без ожидания для некритичных данных (регистрация пользователя и т.п.). Ошибки только логируются"""
+        self._enqueue(func, args).add_done_callback(self._log_error)
+
+    def _log_error(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception():
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка фоновой записи в {os.path.basename(self.db_name)}: {future.exception()}")
+
+    def _enqueue(self, func, args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append(((func, args), future))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        job = asyncio.get_running_loop().run_in_executor(self._writer, self._write_batch, [write for write, _ in batch])
+        job.add_done_callback(lambda done: self._fan_out(done, [future for _, future in batch]))
+
+    def _fan_out(self, job: asyncio.Future, futures):
+        """Раздаёт результаты пакета ожидающим обработчикам"""
+        if job.cancelled():
+            for future in futures:
+                future.cancel()
+            return
+        error = job.exception()
+        for index, future in enumerate(futures):
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+                continue
+            result, exception = job.result()[index]
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def write_sync(self, func, *args):
+        """Синхронная запись для инициализации, когда цикл событий ещё не запущен"""
+        return self._writer.submit(self._write, func, args).result()
+
+    async def export_csv(self, query, path):
+        """
+        Выгружает результат запроса в сжатый gzip CSV. Строки читаются курсором по мере записи, поэтому память не зависит
+        от размера таблицы. Чтение идёт в потоке чтения и в режиме WAL не мешает записи
+        :return: количество выгруженных строк
+        """
+        def export(cursor: sqlite3.Cursor):
+            cursor.arraysize = 1000
+            cursor.execute(query)
+            with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(column[0] for column in cursor.description)
+                rows = 0
+                while batch := cursor.fetchmany():
+                    writer.writerows(batch)
+                    rows += len(batch)
+            return rows
+
+        return await self.read(export)
+
+    def migrate(self, migrations):
+        """
+        Применяет недостающие миграции схемы. Номер версии хранится в PRAGMA user_version:
+        миграция migrations[i] переводит базу на версию i + 1. Каждая миграция выполняется в своей транзакции
+        """
+        def run(cursor: sqlite3.Cursor):
+            version = cursor.execute('PRAGMA user_version').fetchone()[0]
+            for number, migration in enumerate(migrations[version:], version + 1):
+                cursor.execute('BEGIN')
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version={number}')
+                cursor.connection.commit()
+                logger.info(f"{os.path.basename(self.db_name)}: применена миграция {number} ({migration.__name__})")
+            return version
+
+        return self.write_sync(run)
+
+    def close(self):
+        # Дописываем то, что ещё ждёт в очереди записи
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if batch:
+            results = self._writer.submit(self._write_batch, [write for write, _ in batch]).result()
+            for (_, future), (result, exception) in zip(batch, results):
+                if future.done():
+                    continue
+                if exception:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+        with self._instances_lock:
+            if self._instances.get(os.path.abspath(self.db_name)) is self:
+                del self._instances[os.path.abspath(self.db_name)]
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+class Audience:
+    """
+    Сегмент пользователей для рассылки. Условия объединяются через И:
+    joined - диапазон дат регистрации (dd-mm-YYYY..dd-mm-YYYY, любая граница может отсутствовать),
+    warranty - есть ли привязанная консоль в базе гарантий, ticket - есть ли открытый тикет,
+    active - доставляются ли пользователю сообщения (по умолчанию только доставляемые)
+    """
+    options = ('joined', 'warranty', 'ticket', 'active')
+
+    def __init__(self, joined_from=None, joined_to=None, warranty=None, ticket=None, active=True):
+        self.joined_from = joined_from
+        self.joined_to = joined_to
+        self.warranty = warranty
+        self.ticket = ticket
+        self.active = active
+
+    @classmethod
+    def parse(cls, options: dict):
+        """
+        Разбирает параметры вида {'joined': '01-01-2025..31-03-2025', 'warranty': '1'}
+        :raises ValueError: при неизвестном параметре или неверном значении
+        """
+        audience = cls()
+        for key, value in options.items():
+            if key == 'joined':
+                start, _, end = value.partition('..')
+                audience.joined_from = datetime.datetime.strptime(start, '%d-%m-%Y').date() if start else None
+                audience.joined_to = datetime.datetime.strptime(end, '%d-%m-%Y').date() if end else None
+            elif key in ('warranty', 'ticket', 'active'):
+                if value not in ('0', '1'):
+                    raise ValueError(f"{key}={value}")
+                setattr(audience, key, value == '1')
+            else:
+                raise ValueError(key)
+        return audience
+
+    def to_json(self):
+        return json.dumps({
+            'joined_from': self.joined_from.isoformat() if self.joined_from else None,
+            'joined_to': self.joined_to.isoformat() if self.joined_to else None,
+            'warranty': self.warranty,
+            'ticket': self.ticket,
+            'active': self.active,
+        })
+
+    @classmethod
+    def from_json(cls, data):
+        if not data or data == 'all':
+            return cls()
+        data = json.loads(data)
+        for key in ('joined_from', 'joined_to'):
+            if data[key]:
+                data[key] = datetime.date.fromisoformat(data[key])
+        return cls(**data)
+
+    def where(self):
+        """:return: условие на таблицу users и его параметры"""
+        conditions, params = [], []
+        if self.active is not None:
+            conditions.append("users.active = ?")
+            params.append(int(self.active))
+        if self.joined_from:
+            conditions.append("users.date_joined >= ?")
+            params.append(self.joined_from.isoformat())
+        if self.joined_to:
+            conditions.append("users.date_joined < ?")
+            params.append((self.joined_to + datetime.timedelta(days=1)).isoformat())
+        if self.warranty is not None:
+            conditions.append(("" if self.warranty else "NOT ") + "EXISTS (SELECT 1 FROM warranty.warranty WHERE warranty.warranty.tg_id = CAST(users.user_id AS TEXT))")
+        if self.ticket is not None:
+            conditions.append(("" if self.ticket else "NOT ") + "EXISTS (SELECT 1 FROM tickets WHERE tickets.user_id = users.user_id AND tickets.status != 'answered' AND tickets.status != 'closed')")
+        return " AND ".join(conditions) or "1", params
+
+    def describe(self):
+        parts = []
+        if self.joined_from or self.joined_to:
+            parts.append(f"регистрация {self.joined_from.strftime('%d-%m-%Y') if self.joined_from else '...'} - {self.joined_to.strftime('%d-%m-%Y') if self.joined_to else '...'}")
+        if self.warranty is not None:
+            parts.append("с привязанной консолью" if self.warranty else "без привязанной консоли")
+        if self.ticket is not None:
+            parts.append("с открытым тикетом" if self.ticket else "без открытых тикетов")
+        if self.active is False:
+            parts.append("недоступные для доставки")
+        return ", ".join(parts) or "все пользователи"
+
+
 class TicketDb:
-    def __init__(self, db_name="resources/tickets.db"):
+    def __init__(self, db_name="resources/tickets.db", warranty_db_name="resources/warranty.db"):
         self.db_name = db_name
-        self.conn = sqlite3.connect(self.db_name)
-        self.cursor = self.conn.cursor()
-        self.create_tables()
+        # База гарантий подключается для сегментов рассылки по владельцам консолей
+        self.db = SqliteExecutor.shared(self.db_name, attach={'warranty': warranty_db_name})
+        self.db.migrate(self.migrations)
 
     def _close(self):
-        if self.conn:
-            self.conn.close()
+        if self.db:
+            self.db.close()
 
     def __enter__(self):
         return self
@@ -23,10 +348,11 @@ class TicketDb:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._close()
 
-    def create_tables(self):
+    @staticmethod
+    def create_tables(cursor: sqlite3.Cursor):
         """Initialize the database with required tables"""
         # Create tickets table
-        self.cursor.execute("""
+        cursor.execute("""
         CREATE TABLE IF NOT EXISTS tickets (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -43,7 +369,7 @@ class TicketDb:
         """)
 
         # Create ticket_responses table
-        self.cursor.execute("""
+        cursor.execute("""
         CREATE TABLE IF NOT EXISTS ticket_responses (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ticket_id INTEGER,
@@ -59,7 +385,7 @@ class TicketDb:
         """)
 
         # Create users table for newsletter
-        self.cursor.execute("""
+        cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -69,92 +395,215 @@ class TicketDb:
         )
         """)
 
-        self.conn.commit()
+    @staticmethod
+    def add_user_date_indexes(cursor: sqlite3.Cursor):
+        """Индексы под выборки тикетов пользователя и ответов на тикет с сортировкой по дате"""
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user_date ON tickets (user_id, date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_responses_ticket_date ON ticket_responses (ticket_id, date)")
+        # Частичный индекс только по открытым тикетам для get_active_ticket
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_open ON tickets (user_id, date) WHERE status != 'answered'")
 
-    def add_ticket(self, user_id, ticket_id, description, photo_id=None, video_id=None, file_id=None, phone=None):
-        self.cursor.execute("""
-        INSERT INTO tickets (user_id, ticket_id, description, photo_id, video_id, file_id, phone, date)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, ticket_id, description, photo_id, video_id, file_id, phone, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        self.conn.commit()
+    @staticmethod
+    def add_ticket_counters(cursor: sqlite3.Cursor):
+        """Счётчик номеров тикетов по пользователям, начальные значения берутся из существующих тикетов"""
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ticket_counters (
+            user_id INTEGER PRIMARY KEY,
+            last_ticket_id INTEGER NOT NULL
+        )
+        """)
+        cursor.execute("""
+        INSERT OR REPLACE INTO ticket_counters (user_id, last_ticket_id)
+        SELECT user_id, MAX(ticket_id) FROM tickets GROUP BY user_id
+        """)
+
+    @staticmethod
+    def add_broadcasts(cursor: sqlite3.Cursor):
+        """
+        Задания рассылки и их получатели. Статус получателя: 0 - ожидает отправки, 1 - отправлено, 2 - не доставлено.
+        Список получателей фиксируется при создании задания, поэтому после перезапуска рассылка продолжается с того же места
+        """
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            text TEXT,
+            file_id TEXT,
+            audience TEXT,
+            status TEXT DEFAULT "running",
+            chat_id INTEGER,
+            thread_id INTEGER,
+            date TEXT
+        )
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status INTEGER DEFAULT 0,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_recipients_pending ON broadcast_recipients (broadcast_id, user_id) WHERE status = 0")
+
+    @staticmethod
+    def add_user_status(cursor: sqlite3.Cursor):
+        """
+        Статус доставки пользователю: active = 0, если пользователь заблокировал бота или удалил аккаунт.
+        Такие пользователи не попадают в рассылки, частичный индекс содержит только активных
+        """
+        cursor.execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+        cursor.execute("ALTER TABLE users ADD COLUMN status_date TEXT")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users (user_id) WHERE active = 1")
+
+    @staticmethod
+    def add_user_joined_index(cursor: sqlite3.Cursor):
+        """Индекс под сегмент рассылки по дате регистрации"""
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_joined ON users (date_joined)")
+
+    migrations = [create_tables, add_user_date_indexes, add_ticket_counters, add_broadcasts, add_user_status, add_user_joined_index]
+    exports = {
+        'tickets': 'SELECT * FROM tickets',
+        'ticket_responses': 'SELECT * FROM ticket_responses',
+        'users': 'SELECT * FROM users',
+    }
+
+    async def add_ticket(self, user_id, description, photo_id=None, video_id=None, file_id=None, phone=None):
+        """
+        Создаёт тикет, выдавая ему следующий номер в нумерации пользователя
+        :return: номер тикета у пользователя
+        """
+        def insert(cursor: sqlite3.Cursor):
+            # Счётчик увеличивается в той же транзакции, что и вставка тикета, поэтому номера не повторяются
+            ticket_id = cursor.execute("""
+            INSERT INTO ticket_counters (user_id, last_ticket_id) VALUES (?, 1)
+            ON CONFLICT (user_id) DO UPDATE SET last_ticket_id = last_ticket_id + 1
+            RETURNING last_ticket_id
+            """, (user_id,)).fetchone()[0]
+            cursor.execute("""
+            INSERT INTO tickets (user_id, ticket_id, description, photo_id, video_id, file_id, phone, date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, ticket_id, description, photo_id, video_id, file_id, phone, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            return ticket_id
+
+        return await self.db.write(insert)
 
-    def get_ticket(self, user_id, ticket_id):
-        self.cursor.execute("SELECT * FROM tickets WHERE user_id = ? AND ticket_id = ?", (user_id, ticket_id))
-        ticket = self.cursor.fetchone()
-        return ticket
+    async def get_ticket(self, user_id, ticket_id):
+        return await self.db.read(lambda cursor: cursor.execute(
+            "SELECT * FROM tickets WHERE user_id = ? AND ticket_id = ?", (user_id, ticket_id)
+        ).fetchone())
 
-    def add_response(self, ticket_id, user_id, response_text, photo_id=None, video_id=None, file_id=None):
-        self.cursor.execute("""
+    async def add_response(self, ticket_id, user_id, response_text, photo_id=None, video_id=None, file_id=None):
+        await self.db.write(lambda cursor: cursor.execute("""
         INSERT INTO ticket_responses (ticket_id, user_id, response_text, photo_id, video_id, file_id, date)
         VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (ticket_id, user_id, response_text, photo_id, video_id, file_id, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        self.conn.commit()
+        """, (ticket_id, user_id, response_text, photo_id, video_id, file_id, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))))
 
     def add_user(self, user_id, username, first_name, last_name):
-        self.cursor.execute("""
-        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, date_joined)
-        VALUES (?, ?, ?, ?, ?)
-        """, (user_id, username, first_name, last_name, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-        
-        self.conn.commit()
+        """
+        Регистрирует пользователя для рассылки. Запись фоновая: обработчик /start её не ждёт.
+        Повторный /start возвращает пользователя в рассылки, если ему раньше не удавалось доставить сообщение
+        """
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.db.write_later(lambda cursor: cursor.execute("""
+        INSERT INTO users (user_id, username, first_name, last_name, date_joined, status_date)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET active = 1, status_date = excluded.status_date WHERE active = 0
+        """, (user_id, username, first_name, last_name, now, now)))
+
+    async def count_audience(self, audience: Audience):
+        where, params = audience.where()
+        return (await self.db.read(lambda cursor: cursor.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params).fetchone()))[0]
 
-    def get_all_users(self):
-        self.cursor.execute("SELECT user_id FROM users")
-        users = self.cursor.fetchall()
-        return [user[0] for user in users]
+    async def set_users_active(self, user_ids, active):
+        """Пачкой меняет статус доставки пользователей (бот заблокирован / разблокирован)"""
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        await self.db.write(lambda cursor: cursor.executemany(
+            "UPDATE users SET active = ?, status_date = ? WHERE user_id = ? AND active != ?",
+            [(int(active), now, user_id, int(active)) for user_id in user_ids]
+        ))
 
-    def get_all_tickets(self, user_id):
+    async def get_all_tickets(self, user_id):
         """Get all tickets for a specific user"""
-        self.cursor.execute("SELECT * FROM tickets WHERE user_id = ? ORDER BY date DESC", (user_id,))
-        tickets = self.cursor.fetchall()
-        return tickets
+        return await self.db.read(lambda cursor: cursor.execute(
+            "SELECT * FROM tickets WHERE user_id = ? ORDER BY date DESC", (user_id,)
+        ).fetchall())
 
-    def get_latest_ticket(self, user_id):
+    async def get_latest_ticket(self, user_id):
         """Get the latest ticket for a user"""
-        self.cursor.execute("SELECT * FROM tickets WHERE user_id = ? ORDER BY date DESC LIMIT 1", (user_id,))
-        ticket = self.cursor.fetchone()
-        return ticket
+        return await self.db.read(lambda cursor: cursor.execute(
+            "SELECT * FROM tickets WHERE user_id = ? ORDER BY date DESC LIMIT 1", (user_id,)
+        ).fetchone())
 
-    def update_ticket_phone(self, ticket_id, phone):
+    async def update_ticket_phone(self, ticket_id, phone):
         """Update phone number for a ticket"""
-        self.cursor.execute("UPDATE tickets SET phone = ? WHERE id = ?", (phone, ticket_id))
-        self.conn.commit()
+        await self.db.write(lambda cursor: cursor.execute("UPDATE tickets SET phone = ? WHERE id = ?", (phone, ticket_id)))
 
-    def update_ticket_status(self, ticket_id, status):
+    async def update_ticket_status(self, ticket_id, status):
         """Update status for a ticket"""
-        self.cursor.execute("UPDATE tickets SET status = ? WHERE id = ?", (status, ticket_id))
-        self.conn.commit()
+        await self.db.write(lambda cursor: cursor.execute("UPDATE tickets SET status = ? WHERE id = ?", (status, ticket_id)))
 
-    def get_ticket_responses(self, ticket_id):
+    async def get_tickets_page(self, user_id, before=None, after=None, limit=5):
+        """
+        Страница тикетов пользователя (от новых к старым) с краткой сводкой ответов, одним запросом.
+        Пагинация по номеру тикета у пользователя: before - показать тикеты старше этого номера, after - новее
+        :return: список строк (id, ticket_id, description, phone, status, date, responses, attachments, last_response)
+            и флаг наличия ещё одной страницы в направлении выборки
+        """
+        if after is not None:
+            condition, params, order = "AND ticket_id > ?", (user_id, after), "ASC"
+        elif before is not None:
+            condition, params, order = "AND ticket_id < ?", (user_id, before), "DESC"
+        else:
+            condition, params, order = "", (user_id,), "DESC"
+        rows = await self.db.read(lambda cursor: cursor.execute(f"""
+            WITH page AS (
+                SELECT id, ticket_id, description, phone, status, date FROM tickets
+                WHERE user_id = ? {condition}
+                ORDER BY ticket_id {order}
+                LIMIT ?
+            )
+            SELECT page.*,
+                COUNT(r.id),
+                COUNT(r.photo_id) + COUNT(r.video_id) + COUNT(r.file_id),
+                (SELECT response_text FROM ticket_responses WHERE ticket_id = page.id ORDER BY date DESC LIMIT 1)
+            FROM page
+            LEFT JOIN ticket_responses r ON r.ticket_id = page.id
+            GROUP BY page.id
+            ORDER BY page.ticket_id DESC
+        """, (*params, limit + 1)).fetchall())
+        has_more = len(rows) > limit
+        if has_more:
+            # Лишняя строка - самая дальняя в направлении выборки
+            rows = rows[1:] if after is not None else rows[:-1]
+        return rows, has_more
+
+    async def get_ticket_responses(self, ticket_id):
         """Получает все ответы на тикет"""
-        self.cursor.execute("""
+        return await self.db.read(lambda cursor: cursor.execute("""
             SELECT * FROM ticket_responses 
             WHERE ticket_id = ? 
             ORDER BY date ASC
-        """, (ticket_id,))
-        return self.cursor.fetchall()
+        """, (ticket_id,)).fetchall())
 
-    def get_active_ticket(self, user_id):
+    async def get_active_ticket(self, user_id):
         """Получает активный (незакрытый) тикет пользователя"""
-        self.cursor.execute("""
+        return await self.db.read(lambda cursor: cursor.execute("""
             SELECT * FROM tickets 
-            WHERE user_id = ? AND status != "answered" 
+            WHERE user_id = ? AND status != 'answered' 
             ORDER BY date DESC 
             LIMIT 1
-        """, (user_id,))
-        return self.cursor.fetchone()
+        """, (user_id,)).fetchone())
     
-    def rate_ticket(self, ticket_id, rating):
+    async def rate_ticket(self, ticket_id, rating):
         """
         Добавляет оценку закрытому тикету
         :param ticket_id: ID тикета
         :param rating: Оценка от 1 до 5
         """
-        try:
-            self.cursor.execute("SELECT status FROM tickets WHERE id = ?", (ticket_id,))
-            ticket = self.cursor.fetchone()
+        def rate(cursor: sqlite3.Cursor):
+            cursor.execute("SELECT status FROM tickets WHERE id = ?", (ticket_id,))
+            ticket = cursor.fetchone()
             
             if not ticket:
                 return None
@@ -162,28 +611,100 @@ class TicketDb:
             if ticket[0] != "answered":
                 return None
                 
-            self.cursor.execute("""
+            cursor.execute("""
                 UPDATE ticket_responses 
                 SET rating = ?
                 WHERE id = ?
             """, (rating, ticket_id))
-            
-            self.conn.commit()
             return 1
-            
+
+        try:
+            return await self.db.write(rate)
         except Exception as e:
             logger.error(f"{inspect.currentframe().f_code.co_name}\nОшибка при добавлении оценки тикету: {e}")
             return None
     
 
+    async def create_broadcast(self, kind, text, file_id, chat_id, thread_id, audience: Audience = None):
+        """
+        Создаёт задание рассылки и фиксирует список получателей сегмента одним запросом INSERT ... SELECT,
+        id пользователей не передаются через Python
+        :return: id задания и количество получателей
+        """
+        audience = audience or Audience()
+        where, params = audience.where()
+
+        def create(cursor: sqlite3.Cursor):
+            cursor.execute("""
+            INSERT INTO broadcasts (kind, text, file_id, audience, chat_id, thread_id, date)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (kind, text, file_id, audience.to_json(), chat_id, thread_id, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            broadcast_id = cursor.lastrowid
+            cursor.execute(f"INSERT INTO broadcast_recipients (broadcast_id, user_id) SELECT ?, user_id FROM users WHERE {where}", (broadcast_id, *params))
+            return broadcast_id, cursor.rowcount
+
+        return await self.db.write(create)
+
+    async def get_broadcast(self, broadcast_id):
+        """:return: (id, kind, text, file_id, audience, status, chat_id, thread_id, date)"""
+        return await self.db.read(lambda cursor: cursor.execute(
+            "SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)
+        ).fetchone())
+
+    async def get_broadcasts(self, statuses=("running", "paused")):
+        return await self.db.read(lambda cursor: cursor.execute(
+            f"SELECT * FROM broadcasts WHERE status IN ({', '.join('?' * len(statuses))}) ORDER BY id", statuses
+        ).fetchall())
+
+    async def set_broadcast_status(self, broadcast_id, status):
+        await self.db.write(lambda cursor: cursor.execute("UPDATE broadcasts SET status = ? WHERE id = ?", (status, broadcast_id)))
+
+    async def get_broadcast_counts(self, broadcast_id):
+        """:return: количество ожидающих, отправленных и недоставленных сообщений задания"""
+        rows = await self.db.read(lambda cursor: cursor.execute(
+            "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status", (broadcast_id,)
+        ).fetchall())
+        counts = dict(rows)
+        return counts.get(0, 0), counts.get(1, 0), counts.get(2, 0)
+
+    async def get_pending_recipients(self, broadcast_id, after, limit=500):
+        """Следующая пачка получателей, которым ещё не отправлено сообщение, с user_id больше after"""
+        rows = await self.db.read(lambda cursor: cursor.execute("""
+            SELECT user_id FROM broadcast_recipients
+            WHERE broadcast_id = ? AND status = 0 AND user_id > ?
+            ORDER BY user_id
+            LIMIT ?
+        """, (broadcast_id, after, limit)).fetchall())
+        return [row[0] for row in rows]
+
+    async def mark_recipients(self, broadcast_id, sent, failed):
+        """Сохраняет результаты отправки пачкой"""
+        await self.db.write(lambda cursor: cursor.executemany(
+            "UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND user_id = ?",
+            [(1, broadcast_id, user_id) for user_id in sent] + [(2, broadcast_id, user_id) for user_id in failed]
+        ))
+
+
 class PackedData:
+    """Неизменяемая запись о консоли. Одни и те же объекты раздаются из кэша WarrantyDb, поэтому менять их нельзя"""
+    __slots__ = ('console_id', 'sell_date', 'tg_id', 'warranty_id', 'approval_date', 'warranty_expires')
+
+    def __init__(self, console_id=None, sell_date=None, tg_id=None, warranty_id=None, approval_date=None, warranty_expires=None):
+        object.__setattr__(self, 'console_id', console_id)
+        object.__setattr__(self, 'sell_date', sell_date)
+        object.__setattr__(self, 'tg_id', tg_id)
+        object.__setattr__(self, 'warranty_id', warranty_id)
+        object.__setattr__(self, 'approval_date', approval_date)
+        object.__setattr__(self, 'warranty_expires', warranty_expires)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} нельзя изменять")
 
-    def __init__(self, console_id=None, sell_date=None, tg_id=None, warranty_id=None, approval_date=None):
-        self.console_id = console_id
-        self.sell_date = sell_date
-        self.tg_id = tg_id
-        self.warranty_id = warranty_id
-        self.approval_date = approval_date
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} нельзя изменять")
+
+    def __reduce__(self):
+        return type(self), tuple(getattr(self, slot) for slot in self.__slots__)
     
     async def exist(self):
         if self.console_id:
@@ -210,15 +731,49 @@ class PackedData:
             return False
 
 
+def to_day(date=None):
+    """Номер дня от 1970-01-01 для даты (datetime.date или строка dd-mm-YYYY). Без аргумента - сегодняшний день"""
+    if date is None:
+        date = datetime.date.today()
+    elif isinstance(date, str):
+        date = datetime.datetime.strptime(date, '%d-%m-%Y').date()
+    return (date - EPOCH).days
+
+
+def from_day(day):
+    if day is None:
+        return None
+    return EPOCH + datetime.timedelta(days=day)
+
+
 class WarrantyDb:
-    def __init__(self, db_name='resources/warranty.db'):
+    """
+    База гарантий. Даты хранятся как номер дня от 1970-01-01 (см. to_day), наружу отдаются как datetime.date.
+    Записи консолей кэшируются в памяти (LRU на WARRANTY_CACHE_SIZE записей,
+    каждая живёт не дольше WARRANTY_CACHE_TTL секунд), любое изменение консоли сбрасывает её запись
+    """
+    def __init__(self, db_name='resources/warranty.db', cache_size=None, cache_ttl=None):
         self.db_name = db_name
-        self.conn = sqlite3.connect(self.db_name)
-        self.cursor = self.conn.cursor()
-        self.create_tables()
+        self.db = SqliteExecutor.shared(self.db_name)
+        self.db.migrate(self.migrations)
+        self.cache_size = cache_size or int(os.getenv('WARRANTY_CACHE_SIZE', '1024'))
+        self.cache_ttl = cache_ttl if cache_ttl is not None else float(os.getenv('WARRANTY_CACHE_TTL', '300'))
+        self._cache: OrderedDict[str, tuple[float, PackedData]] = OrderedDict()
+        self._cache_version = 0
+        self.hits = 0
+        self.misses = 0
     
-    def create_tables(self):
-        self.cursor.execute('''
+    @staticmethod
+    def warranty_days():
+        """
+        Срок гарантии с компенсацией доставки в днях. Переменные окружения читаются при каждом вызове,
+        а не при импорте модуля, и обязательны: без них дата окончания гарантии была бы неверной
+        """
+        return int(os.getenv('WARRANTY_DURATION')) + int(os.getenv('WARRANTY_COMPENSATION'))
+
+    @staticmethod
+    def create_tables(cursor: sqlite3.Cursor):
+        cursor.execute('''
         CREATE TABLE IF NOT EXISTS warranty (
             console_id INTEGER NOT NULL UNIQUE,
             sell_date TEXT,
@@ -227,10 +782,51 @@ class WarrantyDb:
             approval_date TEXT
         )
         ''')
+
+    @staticmethod
+    def convert_dates_to_days(cursor: sqlite3.Cursor):
+        """
+        Даты продажи и подтверждения переводятся из строк dd-mm-YYYY в номер дня от 1970-01-01, чтобы по ним работали
+        индексы и сравнения. Добавляется дата окончания гарантии warranty_expires, её выставляет approve_warranty
+        """
+        cursor.execute('''
+        CREATE TABLE warranty_new (
+            console_id INTEGER NOT NULL UNIQUE,
+            sell_date INTEGER,
+            tg_id TEXT,
+            warranty_id TEXT UNIQUE,
+            approval_date INTEGER,
+            warranty_expires INTEGER
+        )
+        ''')
+        day = "CAST(julianday(substr({0}, 7, 4) || '-' || substr({0}, 4, 2) || '-' || substr({0}, 1, 2)) - 2440587.5 AS INTEGER)"
+        cursor.execute(f'''
+        INSERT INTO warranty_new
+        SELECT console_id, {day.format('sell_date')}, tg_id, warranty_id, {day.format('approval_date')}, {day.format('approval_date')} + ?
+        FROM warranty
+        ''', (WarrantyDb.warranty_days(),))
+        cursor.execute('DROP TABLE warranty')
+        cursor.execute('ALTER TABLE warranty_new RENAME TO warranty')
+        cursor.execute('CREATE INDEX idx_warranty_sell_date ON warranty (sell_date)')
+        cursor.execute('CREATE INDEX idx_warranty_expires ON warranty (warranty_expires) WHERE warranty_expires IS NOT NULL')
+
+    @staticmethod
+    def add_tg_id_index(cursor: sqlite3.Cursor):
+        """Индекс под сегмент рассылки по владельцам привязанных консолей (см. Audience)"""
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_warranty_tg_id ON warranty (tg_id) WHERE tg_id IS NOT NULL')
+
+    migrations = [create_tables, convert_dates_to_days, add_tg_id_index]
+    exports = {
+        'warranty': '''
+        SELECT console_id, date(sell_date * 86400, 'unixepoch') AS sell_date, tg_id, warranty_id,
+            date(approval_date * 86400, 'unixepoch') AS approval_date, date(warranty_expires * 86400, 'unixepoch') AS warranty_expires
+        FROM warranty
+        ''',
+    }
     
     def _close(self):
-        if self.conn:
-            self.conn.close()
+        if self.db:
+            self.db.close()
 
     def __enter__(self):
         return self
@@ -238,66 +834,129 @@ class WarrantyDb:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._close()
     
-    def _get_warranty_id(self, console_id):
+    @staticmethod
+    def _get_warranty_id(console_id):
         result = ''.join(re.findall(r'\d+', console_id))
         return result
 
-    def _commit_changes(self):
+    async def _commit_changes(self, console_id, query, params):
         try:
-            self.conn.commit()
+            await self.db.write(lambda cursor: cursor.execute(query, params))
             return True
-        except:
-            self.conn.rollback()
+        except Exception as e:
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при изменении базы гарантий: {e}")
             return False
+        finally:
+            self._invalidate(console_id)
+
+    def _invalidate(self, console_id):
+        self._cache.pop(str(console_id), None)
+        # Чтения, начатые до изменения, не должны положить в кэш устаревшую запись
+        self._cache_version += 1
+
+    def cache_stats(self):
+        total = self.hits + self.misses
+        return f"записей {len(self._cache)}, попаданий {self.hits}, промахов {self.misses} ({self.hits / total if total else 0:.0%})"
         
     def _pack_data(self, data):
         if data:
-            return PackedData(data[0], data[1], data[2], data[3], data[4])
+            return PackedData(data[0], from_day(data[1]), data[2], data[3], from_day(data[4]), from_day(data[5]))
         else:
             return PackedData()
 
-    def get_packed(self, console_id):
-        console_data = self._pack_data(self.get_raw(console_id))
+    async def get_packed(self, console_id):
+        key = str(console_id)
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        version = self._cache_version
+        console_data = self._pack_data(await self.get_raw(console_id))
+        if version == self._cache_version:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, console_data)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
         return console_data
         
-    def get_raw(self, console_id):
-        self.cursor.execute('SELECT * FROM warranty WHERE console_id = ?', (console_id,))
-        data = self.cursor.fetchone()
-        return data
+    async def get_raw(self, console_id):
+        return await self.db.read(lambda cursor: cursor.execute(
+            'SELECT * FROM warranty WHERE console_id = ?', (console_id,)
+        ).fetchone())
     
-    def add_console(self, console_id, sell_date=None):
-            self.cursor.execute('INSERT OR IGNORE INTO warranty (console_id, sell_date, tg_id, warranty_id, approval_date) VALUES (?, ?, ?, ?, ?)', (console_id, sell_date, None, None, None))
-            return self._commit_changes() 
+    async def add_console(self, console_id, sell_date=None):
+        if sell_date:
+            sell_date = self._parse_day(sell_date)
+        return await self._commit_changes(console_id, 'INSERT OR IGNORE INTO warranty (console_id, sell_date, tg_id, warranty_id, approval_date) VALUES (?, ?, ?, ?, ?)', (console_id, sell_date, None, None, None))
+    
+    async def add_consoles(self, rows):
+        """
+        Добавляет пачку проданных консолей одной транзакцией. Консоли, которые уже есть в базе, не изменяются
+        :param rows: пары (код консоли, дата продажи)
+        :return: количество добавленных консолей
+        """
+        try:
+            return await self.db.write(lambda cursor: cursor.executemany(
+                'INSERT OR IGNORE INTO warranty (console_id, sell_date) VALUES (?, ?)',
+                [(console_id, to_day(date)) for console_id, date in rows]
+            ).rowcount)
+        finally:
+            for console_id, _ in rows:
+                self._cache.pop(str(console_id), None)
+            self._cache_version += 1
     
-    def remove_console(self, console_id):
-        self.cursor.execute('DELETE FROM warranty WHERE console_id = ?', (console_id,))
-        return self._commit_changes()
+    async def remove_console(self, console_id):
+        return await self._commit_changes(console_id, 'DELETE FROM warranty WHERE console_id = ?', (console_id,))
     
-    def sell_console(self, console_id, date = None):
-        if not date:
-            date = datetime.date.today().strftime('%d-%m-%Y')
-        self.cursor.execute('UPDATE warranty SET sell_date = ? WHERE console_id = ?', (date, console_id))
-        return self._commit_changes()
+    def _parse_day(self, date):
+        try:
+            return to_day(date)
+        except ValueError as e:
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nНекорректная дата {date}: {e}")
+            return None
+
+    async def sell_console(self, console_id, date = None):
+        day = self._parse_day(date)
+        if day is None:
+            return False
+        return await self._commit_changes(console_id, 'UPDATE warranty SET sell_date = ? WHERE console_id = ?', (day, console_id))
     
-    def unsell_console(self, console_id):
-        self.cursor.execute('UPDATE warranty SET sell_date = ?, tg_id = ?, warranty_id = ?, approval_date = ? WHERE console_id = ?', (None, None, None, None, console_id))
-        return self._commit_changes()
+    async def unsell_console(self, console_id):
+        return await self._commit_changes(console_id, 'UPDATE warranty SET sell_date = ?, tg_id = ?, warranty_id = ?, approval_date = ?, warranty_expires = ? WHERE console_id = ?', (None, None, None, None, None, console_id))
         
-    def bind_warranty(self, console_id, tg_id):
+    async def bind_warranty(self, console_id, tg_id):
         warranty_id = self._get_warranty_id(console_id)
-        self.cursor.execute('UPDATE warranty SET tg_id = ?, warranty_id = ? WHERE console_id = ?', (tg_id, warranty_id, console_id))
-        return self._commit_changes()
+        return await self._commit_changes(console_id, 'UPDATE warranty SET tg_id = ?, warranty_id = ? WHERE console_id = ?', (tg_id, warranty_id, console_id))
     
-    def unbind_warranty(self, console_id):
-        self.cursor.execute('UPDATE warranty SET tg_id = ?, warranty_id = ?, approval_date = ? WHERE console_id = ?', (None, None, None, console_id))
-        return self._commit_changes()
-
-    def approve_warranty(self, console_id, date = None):
-        if not date:
-            date = datetime.date.today().strftime('%d-%m-%Y')
-        self.cursor.execute('UPDATE warranty SET approval_date = ? WHERE console_id = ?', (date, console_id))
-        return self._commit_changes()
+    async def unbind_warranty(self, console_id):
+        return await self._commit_changes(console_id, 'UPDATE warranty SET tg_id = ?, warranty_id = ?, approval_date = ?, warranty_expires = ? WHERE console_id = ?', (None, None, None, None, console_id))
+
+    async def approve_warranty(self, console_id, date = None):
+        day = self._parse_day(date)
+        if day is None:
+            return False
+        return await self._commit_changes(console_id, 'UPDATE warranty SET approval_date = ?, warranty_expires = ? WHERE console_id = ?', (day, day + self.warranty_days(), console_id))
     
-    def unapprove_warranty(self, console_id):
-        self.cursor.execute('UPDATE warranty SET approval_date = ? WHERE console_id = ?', (None, console_id))
-        return self._commit_changes()
\ No newline at end of file
+    async def unapprove_warranty(self, console_id):
+        return await self._commit_changes(console_id, 'UPDATE warranty SET approval_date = ?, warranty_expires = ? WHERE console_id = ?', (None, None, console_id))
+
+    async def get_expiring(self, start, end, limit=50):
+        """
+        Консоли, гарантия которых заканчивается в промежутке [start, end], по индексу warranty_expires
+        :return: список PackedData, отсортированный по дате окончания, и общее количество таких консолей
+        """
+        def select(cursor: sqlite3.Cursor):
+            rows = cursor.execute(
+                'SELECT * FROM warranty WHERE warranty_expires BETWEEN ? AND ? ORDER BY warranty_expires LIMIT ?',
+                (to_day(start), to_day(end), limit)
+            ).fetchall()
+            total = cursor.execute(
+                'SELECT COUNT(*) FROM warranty WHERE warranty_expires BETWEEN ? AND ?', (to_day(start), to_day(end))
+            ).fetchone()[0]
+            return rows, total
+
+        rows, total = await self.db.read(select)
+        return [self._pack_data(row) for row in rows], total
\ No newline at end of file
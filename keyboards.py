@@ -57,6 +57,17 @@ def support():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def tickets_page(newer=None, older=None):
+    """Клавиатура для постраничного просмотра тикетов. newer/older - номера крайних тикетов на странице"""
+    navigation = []
+    if newer is not None:
+        navigation.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"my_tickets newer {newer}"))
+    if older is not None:
+        navigation.append(InlineKeyboardButton("Старее ➡️", callback_data=f"my_tickets older {older}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("🔙 Вернуться в меню", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard)
+
 def supp_rating():
     """Клавиатура для оценки ответа поддержки"""
     keyboard = [
@@ -1,7 +1,11 @@
 import os
 import logging
 import re
-from telegram import Update
+import asyncio
+import tempfile
+import code_import
+import broadcast
+from telegram import Update, Chat, ChatMember, ChatMemberUpdated
 from telegram.ext import ContextTypes
 import states
 import keyboards
@@ -9,16 +13,17 @@ import inspect
 from database import (
     TicketDb,
     WarrantyDb,
-    PackedData
+    PackedData,
+    Audience
 )
-from datetime import datetime
+from datetime import datetime, timedelta
 from media_handler import MediaManager
 from re_codes import Format
 
 logger = logging.getLogger(__name__)
 media_manager: MediaManager = None
-tickets_db = TicketDb()
-warranty_db = WarrantyDb()
+tickets_db: TicketDb = None
+warranty_db: WarrantyDb = None
 
 class BotCallbackData:
     NEXT_LICENCE = "next_licence"
@@ -56,11 +61,24 @@ class Utility:
             "<code>/newsletter [текст сообщения]</code> - Разослать сообщение всем пользователям принявшим лицензионное соглашение.\n" \
             "Пример:\n" \
             "<b>/newsletter текст сообщения</b>\n" \
+            "Перед текстом можно указать сегмент: <code>joined=[дата]..[дата]</code> - дата регистрации, <code>warranty=1</code> или <code>0</code> - есть ли привязанная консоль, <code>ticket=1</code> или <code>0</code> - есть ли открытый тикет, <code>active=0</code> - только пользователи, которым не удалось доставить сообщение\n" \
+            "Пример:\n" \
+            "<b>/newsletter warranty=1 joined=01-01-2025..31-03-2025 текст сообщения</b>\n" \
+            "\n" \
+            "<code>/newsletters</code> - список незавершённых рассылок\n" \
+            "\n" \
+            "<code>/newsletter_pause [номер]</code>, <code>/newsletter_resume [номер]</code>, <code>/newsletter_cancel [номер]</code> - приостановить, продолжить или отменить рассылку\n" \
+            "Пример:\n" \
+            "<b>/newsletter_pause 3</b>\n" \
             "\n" \
             "<code>/approve_warranty [код консоли]</code> - одобить гарантию для консоли и уведомить пользователя.\n" \
             "Пример:\n" \
             "<b>/approve_warranty ATJ10561484807</b>\n" \
             "\n" \
+            "<code>/export [таблица]</code> - выгрузить данные в сжатый CSV. Без названия таблицы выгружаются все: tickets, ticket_responses, users, warranty\n" \
+            "Пример:\n" \
+            "<b>/export warranty</b>\n" \
+            "\n" \
             "<code>/reply [tg_id пользователя] [номер тикета] [текст ответа]</code> - ответить на тикет пользователя. Можно прикрепить 1 медифайл.\n" \
             "Пример:\n" \
             "<b>/reply 123456789 1 текст ответа</b>\n" \
@@ -82,6 +100,14 @@ class Utility:
             "Пример:\n" \
             "<b>ATJ10561484807</b>\n" \
             "\n" \
+            "<code>[файл CSV, XLSX или TXT]</code> - добавить консоли из файла и пометить как проданные. В каждой строке код консоли и, при необходимости, дата продажи. Без даты консоль помечается проданной сегодня. Для XLSX на сервере нужен пакет openpyxl\n" \
+            "Пример строки:\n" \
+            "<b>ATJ10561484807;31-12-2025</b>\n" \
+            "\n" \
+            "<code>/expiring [количество дней]</code> - список консолей, гарантия которых закончится в ближайшие дни. Если не указать количество дней, будет выбрано 30\n" \
+            "Пример:\n" \
+            "<b>/expiring 14</b>\n" \
+            "\n" \
             "<code>/remove [код консоли]</code> - удалить все данные консоли из базы\n" \
             "Пример:\n" \
             "<b>/remove ATJ10561484807</b>\n" \
@@ -135,7 +161,7 @@ class SupportManager:
             try:
                 re_code = re.match(r'(?i)^/approve_warranty ('+Format.console_code+r')$', update.message.text)
                 console_id = re_code.group(1)
-                console: PackedData = warranty_db.get_packed(console_id)
+                console: PackedData = await warranty_db.get_packed(console_id)
                 if not await console.exist():
                     await update.message.reply_text("➖ Консоль не найдена в базе данных")
                     return
@@ -149,7 +175,7 @@ class SupportManager:
                     await update.message.reply_text("❌ Гарантия на эту консоль уже одобрена")
                     return
                 
-                if warranty_db.approve_warranty(console_id):
+                if await warranty_db.approve_warranty(console_id):
                     await update.message.reply_text("✅ Гарантия успешно одобрена!")
                     try:
                         await context.bot.send_message(
@@ -246,7 +272,7 @@ class SupportManager:
                 document = update.message.document if update.message.document else None
                 
                 # Сохраняем ответ в базу данных
-                tickets_db.add_response(
+                await tickets_db.add_response(
                     ticket_id=ticket_id,
                     user_id=user_id,
                     response_text=response_text,
@@ -255,7 +281,7 @@ class SupportManager:
                     file_id=document.file_id if document else None
                 )
 
-                tickets_db.update_ticket_status(ticket_id, 'answered')
+                await tickets_db.update_ticket_status(ticket_id, 'answered')
 
                 try:
                     if photo:
@@ -314,52 +340,104 @@ class SupportManager:
         except:
             message_text = re.match(r'(?i)^/newsletter\s+(.+)', update.message.caption).group(1)
 
-        photo = update.message.photo[-1] if update.message.photo else None
-        video = update.message.video if update.message.video else None
-        document = update.message.document if update.message.document else None
-        
-        users = tickets_db.get_all_users()
-        
-        success_count = 0
-        fail_count = 0
-        
-        for user_id in users:
-            try:
-                if photo:
-                    await context.bot.send_photo(
-                        chat_id=user_id,
-                        caption=message_text,
-                        photo=photo
-                    )
-                elif video:
-                    await context.bot.send_video(
-                        chat_id=user_id,
-                        caption=message_text,
-                        video=video
-                    )
-                elif document:
-                    await context.bot.send_document(
-                        chat_id=user_id,
-                        caption=message_text,
-                        document=document
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=message_text
-                    )
-                success_count += 1
-            except Exception as e:
-                logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при отправке рассылки пользователю {user_id}: {e}")
-                fail_count += 1
-        
-        # Отправляем отчет о рассылке
+        if update.message.photo:
+            payload = broadcast.Payload('photo', message_text, update.message.photo[-1].file_id)
+        elif update.message.video:
+            payload = broadcast.Payload('video', message_text, update.message.video.file_id)
+        elif update.message.document:
+            payload = broadcast.Payload('document', message_text, update.message.document.file_id)
+        else:
+            payload = broadcast.Payload('text', message_text)
+
+        # Параметры сегмента идут перед текстом: /newsletter warranty=1 joined=01-01-2025..31-03-2025 текст
+        options = {}
+        while (option := re.match(r'(\w+)=(\S+)\s+', payload.text)) and option.group(1).lower() in Audience.options:
+            options[option.group(1).lower()] = option.group(2)
+            payload.text = payload.text[option.end():]
+        try:
+            audience = Audience.parse(options)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ Неверный параметр сегмента: {e}")
+            return
+        if not await tickets_db.count_audience(audience):
+            await update.message.reply_text(f"➖ В сегменте нет пользователей ({audience.describe()})")
+            return
+
+        # Рассылка сохраняется в базе и идёт в фоне, отчёт придёт в этот же топик
+        broadcast_id, recipients = await broadcast.jobs.create(payload, update.message.chat_id, update.message.message_thread_id, audience)
         await update.message.reply_text(
-            f"📊 Результаты рассылки:\n"
-            f"✅ Успешно отправлено: {success_count}\n"
-            f"❌ Не удалось отправить: {fail_count}"
+            f"⏳ Рассылка #{broadcast_id} запущена, получателей: {recipients} ({audience.describe()})\n"
+            f"Управление: /newsletter_pause {broadcast_id}, /newsletter_resume {broadcast_id}, /newsletter_cancel {broadcast_id}"
         )
 
+    async def newsletter_control(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/newsletter_pause, /newsletter_resume, /newsletter_cancel [номер рассылки]"""
+        if await SupportManager._check_thread(update):
+            action, broadcast_id = re.match(r'(?i)^/newsletter_(pause|resume|cancel) (\d+)$', update.message.text).groups()
+            action, broadcast_id = action.lower(), int(broadcast_id)
+            if action == 'pause':
+                done, result = await broadcast.jobs.pause(broadcast_id), 'приостановлена'
+            elif action == 'resume':
+                done, result = await broadcast.jobs.resume(broadcast_id), 'продолжена'
+            else:
+                done, result = await broadcast.jobs.cancel(broadcast_id), 'отменена'
+
+            if done:
+                pending, sent, failed = await tickets_db.get_broadcast_counts(broadcast_id)
+                await update.message.reply_text(f"✅ Рассылка #{broadcast_id} {result}\nОтправлено: {sent}, не доставлено: {failed}, осталось: {pending}")
+            else:
+                await update.message.reply_text(f"➖ Рассылка #{broadcast_id} не найдена или уже завершена")
+
+    async def newsletters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/newsletters - список незавершённых рассылок"""
+        if await SupportManager._check_thread(update):
+            jobs = await tickets_db.get_broadcasts()
+            if not jobs:
+                await update.message.reply_text("➖ Нет активных рассылок")
+                return
+            message = "📋 Активные рассылки:\n"
+            for broadcast_id, _, text, _, _, status, _, _, date in jobs:
+                pending, sent, failed = await tickets_db.get_broadcast_counts(broadcast_id)
+                status = "▶️ идёт" if status == "running" else "⏸ на паузе"
+                message += f"\n#{broadcast_id} {status}, создана {date}\nОтправлено: {sent}, не доставлено: {failed}, осталось: {pending}\n{text[:50]}\n"
+            await update.message.reply_text(message)
+
+    async def export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        /export [таблица] - выгрузка таблиц баз в сжатый CSV. Без аргумента выгружаются все таблицы.
+        Выгрузка идёт в фоновой задаче, обработчики бота в это время продолжают работать
+        """
+        if await SupportManager._check_thread(update):
+            tables = {table: tickets_db for table in tickets_db.exports} | {table: warranty_db for table in warranty_db.exports}
+            requested = update.message.text.lower().split()[1:]
+            unknown = [table for table in requested if table not in tables]
+            if unknown:
+                await update.message.reply_text(f'➖ Неизвестные таблицы: {", ".join(unknown)}\nДоступны: {", ".join(tables)}')
+                return
+
+            await update.message.reply_text('⏳ Готовим выгрузку, файлы придут отдельными сообщениями')
+            context.application.create_task(
+                SupportManager._export_tables(update.message, {table: tables[table] for table in requested or tables}),
+                update=update
+            )
+
+    async def _export_tables(message, tables):
+        date = datetime.now().strftime('%Y-%m-%d')
+        with tempfile.TemporaryDirectory() as directory:
+            for table, db in tables.items():
+                filename = f'{table}_{date}.csv.gz'
+                path = os.path.join(directory, filename)
+                try:
+                    rows = await db.db.export_csv(db.exports[table], path)
+                    with open(path, 'rb') as f:
+                        await message.reply_document(f, filename=filename, caption=f'📦 {table}: {rows} строк', read_timeout=120, write_timeout=120)
+                except Exception as e:
+                    logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при выгрузке таблицы {table}: {e}")
+                    await message.reply_text(f'❌ Не удалось выгрузить таблицу {table}')
+                finally:
+                    if os.path.exists(path):
+                        os.remove(path)
+
 class ConsoleCodes:
 
     codes_thread_id = int(os.getenv('CODES_THREAD_ID'))
@@ -377,13 +455,14 @@ class ConsoleCodes:
         """
         Преобразует упакованные данные консоли в строку готовую к отправке
         """
-        data_str = f'<code>{data.console_id}</code> - Код консоли\n<code>{data.sell_date}</code> - Дата продажи\n<code>{data.tg_id}</code> - TG_ID\n<code>{data.warranty_id}</code> - Код гарантии\n<code>{data.approval_date}</code> - Дата подтверждения гарантии'
+        sell_date, approval_date, warranty_expires = (date.strftime(Format.date) if date else None for date in (data.sell_date, data.approval_date, data.warranty_expires))
+        data_str = f'<code>{data.console_id}</code> - Код консоли\n<code>{sell_date}</code> - Дата продажи\n<code>{data.tg_id}</code> - TG_ID\n<code>{data.warranty_id}</code> - Код гарантии\n<code>{approval_date}</code> - Дата подтверждения гарантии\n<code>{warranty_expires}</code> - Дата окончания гарантии'
         return data_str
         
     async def get_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if await ConsoleCodes._check_thread(update):
             console_id = re.match(r'(?i)^/data ('+Format.console_code+')$', update.message.text).group(1)
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if await console.exist():
                 await update.message.reply_text(f'✅ Данные консоли\n{await ConsoleCodes._form_data_string(console)}', parse_mode='HTML')
             else:
@@ -392,23 +471,80 @@ class ConsoleCodes:
     async def add_console_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if await ConsoleCodes._check_thread(update):
             console_id = update.message.text
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if await console.exist():
                 await update.message.reply_text('➖ Консоль уже есть в базе')
             else:
-                if warranty_db.add_console(console_id) and warranty_db.sell_console(console_id):
+                if await warranty_db.add_console(console_id) and await warranty_db.sell_console(console_id):
                     await update.message.reply_text('✅ Консоль успешно добавлена в базу и помечена как проданная')
                 else:
                     await update.message.reply_text('❌ Произошла ошибка при внесении изменений в базу')
     
+    async def expiring(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """/expiring [дней] - консоли, гарантия которых закончится в ближайшие дни (по умолчанию 30)"""
+        if await ConsoleCodes._check_thread(update):
+            days = re.match(r'(?i)^/expiring(?: (\d+))?$', update.message.text).group(1)
+            today = datetime.now().date()
+            consoles, total = await warranty_db.get_expiring(today, today + timedelta(days=int(days or 30)))
+            if not consoles:
+                await update.message.reply_text('➖ Нет гарантий, которые заканчиваются в этот период')
+                return
+            message = f'📅 Гарантии, которые заканчиваются в ближайшие {days or 30} дней: {total}\n\n'
+            message += '\n'.join(f'<code>{console.console_id}</code> - {console.warranty_expires.strftime(Format.date)}' for console in consoles)
+            if total > len(consoles):
+                message += f'\n... и ещё {total - len(consoles)}'
+            await update.message.reply_text(message, parse_mode='HTML')
+
+    async def import_codes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Массовое добавление проданных консолей из файла CSV, XLSX или TXT"""
+        if await ConsoleCodes._check_thread(update):
+            document = update.message.document
+            extension = os.path.splitext(document.file_name or '')[1].lower().lstrip('.')
+            if extension not in code_import.extensions:
+                await update.message.reply_text('➖ Поддерживаются только файлы CSV, XLSX и TXT')
+                return
+
+            await update.message.reply_text('⏳ Импорт кодов консолей...')
+            report = code_import.ImportReport()
+            try:
+                with tempfile.TemporaryDirectory() as directory:
+                    path = os.path.join(directory, f'codes.{extension}')
+                    await (await document.get_file()).download_to_drive(path)
+                    chunks = code_import.parse(path, extension, report)
+                    # Файл разбирается в отдельном потоке по одной пачке, запись идёт параллельно с разбором следующей
+                    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                        inserted = await warranty_db.add_consoles(chunk)
+                        report.inserted += inserted
+                        report.skipped += len(chunk) - inserted
+            except ImportError as e:
+                await update.message.reply_text(f'❌ {e}')
+                return
+            except Exception as e:
+                logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при импорте кодов консолей: {e}")
+                await update.message.reply_text(
+                    '❌ Произошла ошибка при импорте. Изменения до момента ошибки сохранены\n'
+                    f'Добавлено: {report.inserted}, пропущено: {report.skipped}, с ошибками: {report.invalid}'
+                )
+                return
+
+            message = (
+                '✅ Импорт завершён\n'
+                f'Добавлено: {report.inserted}\n'
+                f'Пропущено (уже в базе): {report.skipped}\n'
+                f'С ошибками: {report.invalid}'
+            )
+            if report.invalid_lines:
+                message += f'\nСтроки с ошибками: {", ".join(map(str, report.invalid_lines))}' + (' ...' if report.invalid > len(report.invalid_lines) else '')
+            await update.message.reply_text(message)
+
     async def remove_console(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if await ConsoleCodes._check_thread(update):
             console_id = re.match(r'(?i)^/remove ('+Format.console_code+')$', update.message.text).group(1)
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if not await console.exist():
                 await update.message.reply_text('➖ Консоли нет в базе')  
             else:
-                if warranty_db.remove_console(console_id):
+                if await warranty_db.remove_console(console_id):
                     await update.message.reply_text(f'✅ Консоль успешно удалена из базы\nДанные до удаления:\n{await ConsoleCodes._form_data_string(console)}', parse_mode='HTML')
                 else:
                     await update.message.reply_text('❌ Произошла ошибка при внесении изменений в базу')
@@ -423,13 +559,13 @@ class ConsoleCodes:
                 re_code = re.match(r'(?i)^/sell ('+Format.console_code+r')$', update.message.text)
                 console_id = re_code.group(1)
                 date = None
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if not await console.exist():
                 await update.message.reply_text('➖ Консоли нет в базе')
             if await console.sold():
                 await update.message.reply_text('➖ Консоль уже была продана')
             else:
-                if warranty_db.sell_console(console_id, date):
+                if await warranty_db.sell_console(console_id, date):
                     await update.message.reply_text('✅ Консоль успешно помечена как проданная')
                 else:
                     await update.message.reply_text('❌ Произошла ошибка при внесении изменений в базу')
@@ -437,13 +573,13 @@ class ConsoleCodes:
     async def unsell_console(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if await ConsoleCodes._check_thread(update):
             console_id = re.match(r'(?i)^/unsell ('+Format.console_code+')$', update.message.text).group(1)
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if not await console.exist():
                 await update.message.reply_text('➖ Консоли нет в базе')
             elif not await console.sold():
                 await update.message.reply_text('➖ Консоль не была помечена как проданная')
             else:
-                if warranty_db.unsell_console(console_id):
+                if await warranty_db.unsell_console(console_id):
                     await update.message.reply_text(f'✅ Консоль успешно помечена как не проданная\nДанные до удаления:\n{await ConsoleCodes._form_data_string(console)}', parse_mode='HTML')
                 else:
                     await update.message.reply_text('❌ Произошла ошибка при внесении изменений в базу')
@@ -453,7 +589,7 @@ class ConsoleCodes:
             re_code = re.match(r'(?i)^/bind ('+Format.console_code+') ('+Format.tg_id+')$', update.message.text)
             console_id = re_code.group(1) 
             tg_id = re_code.group(2)
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if not await console.exist():
                 await update.message.reply_text('➖ Консоли нет в базе')
             if not await console.sold():
@@ -461,7 +597,7 @@ class ConsoleCodes:
             elif await console.bound():
                 await update.message.reply_text('➖ Гарантия к консоли уже была привязана')
             else:
-                if warranty_db.bind_warranty(console_id, tg_id):
+                if await warranty_db.bind_warranty(console_id, tg_id):
                     await update.message.reply_text('✅ Гарантия успешно привязана')
                 else:
                     await update.message.reply_text('❌ Произошла ошибка при внесении изменений в базу')
@@ -469,13 +605,13 @@ class ConsoleCodes:
     async def unbind_warranty(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if await ConsoleCodes._check_thread(update):
             console_id = re.match(r'(?i)^/unbind ('+Format.console_code+')$', update.message.text).group(1)
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if not await console.exist():
                 await update.message.reply_text('➖ Консоли нет в базе')
             if not await console.bound():
                 await update.message.reply_text('➖ Гарантия не была привязана к консоли')
             else:
-                if warranty_db.unbind_warranty(console_id):
+                if await warranty_db.unbind_warranty(console_id):
                     await update.message.reply_text(f'✅ Гарантия успешно отвязана от консоли\nДанные до удаления:\n{await ConsoleCodes._form_data_string(console)}', parse_mode='HTML')
                 else:
                     await update.message.reply_text('❌ Произошла ошибка при внесении изменений в базу')
@@ -490,7 +626,7 @@ class ConsoleCodes:
                 re_code = re.match(r'(?i)^/approve ('+Format.console_code+')$', update.message.text)
                 console_id = re_code.group(1)
                 date = None
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if not await console.exist():
                 await update.message.reply_text('➖ Консоли нет в базе')
             if not await console.sold():
@@ -500,7 +636,7 @@ class ConsoleCodes:
             elif await console.approved():
                 await update.message.reply_text('➖ Гарантия для консоли уже была одобрена')
             else:
-                if warranty_db.approve_warranty(console_id, date):
+                if await warranty_db.approve_warranty(console_id, date):
                     await update.message.reply_text('✅ Гарантия одобрена')
                 else:
                     await update.message.reply_text('❌ Произошла ошибка при внесении изменений в базу')
@@ -508,13 +644,13 @@ class ConsoleCodes:
     async def unapprove(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if await ConsoleCodes._check_thread(update):
             console_id = re.match(r'(?i)^/unapprove ('+Format.console_code+')$', update.message.text).group(1)
-            console = warranty_db.get_packed(console_id)
+            console = await warranty_db.get_packed(console_id)
             if not await console.exist():
                 await update.message.reply_text('➖ Консоли нет в базе')
             if not await console.approved():
                 await update.message.reply_text('➖ Гарантия для консоли не была одобрена')
             else:
-                if warranty_db.unapprove_warranty(console_id):
+                if await warranty_db.unapprove_warranty(console_id):
                     await update.message.reply_text(f'✅ Гарантия успешно отозвана\nДанные до удаления:\n{await ConsoleCodes._form_data_string(console)}', parse_mode='HTML')
                 else:
                     await update.message.reply_text('❌ Произошла ошибка при внесении изменений в базу')
@@ -524,6 +660,16 @@ class UserConversation:
     from _support import _support as Support
     from _warranty import _warranty as Warranty
 
+    async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отмечает, что пользователь заблокировал или разблокировал бота, чтобы рассылки не тратили на него лимит"""
+        member: ChatMemberUpdated = update.my_chat_member
+        if member.chat.type != Chat.PRIVATE:
+            return
+        if member.new_chat_member.status in (ChatMember.BANNED, ChatMember.LEFT):
+            await tickets_db.set_users_active([member.chat.id], False)
+        elif member.new_chat_member.status == ChatMember.MEMBER:
+            await tickets_db.set_users_active([member.chat.id], True)
+
     licence_error_cap = 'Не получилось отправить пользовательское соглашение, перезапустите бота немного позже ↩️ либо ознакомьтесь с соглашением в соответствующем разделе'
     internal_error_cap = '🛑 Произошла внутрення ошибка, пожалуйста перезапустите бота командой /start'
     start_cap = "🎮 Присоединяйтесь к нашему игровому комьюнити 🎮!\n\n" \
@@ -697,7 +843,7 @@ class UserConversation:
         elif query.data == "create_ticket":
             return await UserConversation.Support._create_ticket(update, context)
 
-        elif query.data == "my_tickets":
+        elif query.data.startswith("my_tickets"):
             return await UserConversation.Support.show_user_tickets(update, context)
         
         elif 'ticket_rating' in query.data:
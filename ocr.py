@@ -0,0 +1,731 @@
+import os
+import logging
+import inspect
+import threading
+import asyncio
+import multiprocessing
+import sqlite3
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from database import SqliteExecutor
+
+logger = logging.getLogger(__name__)
+
+# OpenCV, numpy, easyocr и torch импортируются при первом обращении к OCR, а не при запуске бота
+cv2 = None
+np = None
+
+def load_stack():
+    """Импортирует OpenCV и numpy. Повторные вызовы ничего не делают"""
+    global cv2, np
+    if cv2 is None:
+        import numpy as numpy_module
+        import cv2 as cv2_module
+        np, cv2 = numpy_module, cv2_module
+
+class OcrEngine:
+    """Общая для процесса модель easyocr. Загружается один раз и переиспользуется всеми проверками гарантии"""
+
+    def __init__(self, languages=None, model_dir=None):
+        self.languages = languages or [l.strip() for l in os.getenv('OCR_LANGUAGES', 'ru').split(',') if l.strip()]
+        self.model_dir = model_dir or os.getenv('OCR_MODEL_DIR') or None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            with self._lock:
+                if self._reader is None:
+                    self._reader = self._load()
+        return self._reader
+
+    def _load(self):
+        logger.info(f"Загрузка модели OCR ({', '.join(self.languages)})...")
+        try:
+            import easyocr
+            reader = easyocr.Reader(
+                self.languages,
+                model_storage_directory=self.model_dir,
+                verbose=False
+            )
+        except Exception as e:
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при загрузке модели OCR: {e}")
+            raise
+        logger.info("Модель OCR загружена")
+        return reader
+
+    def warm_up(self):
+        """Загружает модель заранее, чтобы первая проверка не ждала инициализации"""
+        return self.reader
+
+engine = OcrEngine()
+
+
+class Preprocessor:
+    """
+    Подготовка скриншота отзыва к распознаванию.
+    Изображение уменьшается до рабочего размера, затем ищутся строки текста, похожие на последовательности цифр.
+    В распознавание передаются только эти фрагменты, а не весь скриншот
+    """
+
+    def __init__(self, target_width=None, max_regions=None, use_regions=None):
+        self.target_width = target_width or int(os.getenv('OCR_TARGET_WIDTH', '1080'))
+        self.max_regions = max_regions or int(os.getenv('OCR_MAX_REGIONS', '12'))
+        self.use_regions = use_regions if use_regions is not None else os.getenv('OCR_REGIONS', '1') == '1'
+        self.min_height = 8
+        self.max_height = 90
+        self.padding = 4
+
+    def decode(self, photo_bytes, width=None):
+        """
+        Декодирует скриншот сразу в оттенки серого без промежуточных копий.
+        Если ширина известна заранее и намного больше рабочей, JPEG уменьшается прямо при декодировании
+        """
+        load_stack()
+        flag = cv2.IMREAD_GRAYSCALE
+        if width and width >= 4 * self.target_width:
+            flag = cv2.IMREAD_REDUCED_GRAYSCALE_4
+        elif width and width >= 2 * self.target_width:
+            flag = cv2.IMREAD_REDUCED_GRAYSCALE_2
+        return cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), flag)
+
+    def downscale(self, gray):
+        height, width = gray.shape[:2]
+        if width <= self.target_width:
+            return gray
+        scale = self.target_width / width
+        return cv2.resize(gray, (self.target_width, int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    def find_regions(self, gray):
+        """Возвращает фрагменты изображения со строками текста, отсортированные сверху вниз"""
+        if not self.use_regions:
+            return [gray]
+        gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+        binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+        # Склеиваем соседние символы в строки
+        lines = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (31, 3)))
+        contours = cv2.findContours(lines, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
+
+        candidates = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if not self.min_height <= h <= self.max_height or w < h * 2:
+                continue
+            density = cv2.countNonZero(binary[y:y + h, x:x + w]) / float(w * h)
+            if density < 0.2:
+                continue
+            candidates.append((density * w, x, y, w, h))
+
+        candidates = sorted(candidates, reverse=True)[:self.max_regions]
+        height, width = gray.shape[:2]
+        regions = []
+        for _, x, y, w, h in sorted(candidates, key=lambda c: (c[2], c[1])):
+            y0, y1 = max(0, y - self.padding), min(height, y + h + self.padding)
+            x0, x1 = max(0, x - self.padding), min(width, x + w + self.padding)
+            regions.append(gray[y0:y1, x0:x1])
+        return regions
+
+    def binarize(self, gray, method):
+        if method == 'adaptive':
+            return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+        return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+
+preprocessor = Preprocessor()
+
+
+class Verdict:
+    APPROVED = 'approved'
+    MANUAL = 'manual'
+    REJECTED = 'rejected'
+
+
+class Match:
+
+    def __init__(self, verdict, score=0.0, distance=None, fragment=''):
+        self.verdict = verdict
+        self.score = score
+        self.distance = distance
+        self.fragment = fragment
+
+
+class WarrantyMatcher:
+    """
+    Нечёткий поиск кода гарантии в результатах OCR.
+    В цифрах каждой распознанной строки ищется фрагмент с минимальным расстоянием Левенштейна до кода.
+    Строки не склеиваются, чтобы код не собирался из цифр соседних надписей.
+    Точное совпадение получает оценку 1. Для неточного оценка учитывает расстояние и уверенность OCR в строке
+    с найденным фрагментом: высокая оценка - гарантия одобряется, пограничная - скриншот уходит на ручную проверку
+    """
+
+    def __init__(self, approve_score=None, review_score=None):
+        self.approve_score = approve_score or float(os.getenv('OCR_APPROVE_SCORE', '0.9'))
+        self.review_score = review_score or float(os.getenv('OCR_REVIEW_SCORE', '0.5'))
+
+    def _search(self, pattern, stream):
+        """
+        Расстояние от pattern до ближайшей подстроки stream (выравнивание без штрафа за концы stream)
+        :return: расстояние, начало и конец подстроки
+        """
+        column = [(j, 0) for j in range(len(pattern) + 1)]
+        best = (len(pattern), 0, 0)
+        for i, char in enumerate(stream, 1):
+            current = [(0, i)]
+            for j, expected in enumerate(pattern, 1):
+                current.append(min(
+                    (column[j - 1][0] + (expected != char), column[j - 1][1]),
+                    (column[j][0] + 1, column[j][1]),
+                    (current[j - 1][0] + 1, current[j - 1][1]),
+                ))
+            column = current
+            if column[-1][0] < best[0]:
+                best = (column[-1][0], column[-1][1], i)
+        return best
+
+    def match(self, tokens, warranty_id) -> Match:
+        """
+        :param tokens: распознанные строки - пары (текст, уверенность) или просто текст
+        """
+        if not warranty_id:
+            return Match(Verdict.REJECTED)
+
+        best = None
+        for token in tokens:
+            text, confidence = (token, 1.0) if isinstance(token, str) else token
+            digits = "".join(char for char in text if char.isdigit())
+            if not digits:
+                continue
+            distance, start, end = self._search(warranty_id, digits)
+            # Точное совпадение одобряется как раньше, уверенность OCR учитывается только для неточных
+            score = 1.0 if distance == 0 else (1 - distance / len(warranty_id)) * float(confidence)
+            if best is None or score > best.score:
+                best = Match(None, score, distance, digits[start:end])
+
+        if best is None:
+            return Match(Verdict.REJECTED)
+        if best.score >= self.approve_score:
+            best.verdict = Verdict.APPROVED
+        elif best.score >= self.review_score:
+            best.verdict = Verdict.MANUAL
+        else:
+            best.verdict = Verdict.REJECTED
+        return best
+
+matcher = WarrantyMatcher()
+
+
+class Recognition:
+    """Результат поиска кода гарантии: распознанные строки (текст, уверенность), найден ли код и оценка совпадения"""
+
+    def __init__(self, tokens=None, found=False, confidence=0.0):
+        self.tokens = tokens or []
+        self.found = found
+        self.confidence = confidence
+
+
+class Recognizer:
+    """Интерфейс распознавателя. Получает фрагменты скриншота и ищет в них код гарантии"""
+
+    name = None
+    uses_easyocr = False
+
+    def recognize(self, regions, warranty_id) -> Recognition:
+        raise NotImplementedError
+
+    def recognize_batch(self, jobs) -> list:
+        """Обрабатывает несколько скриншотов. jobs - список пар (фрагменты, код гарантии)"""
+        return [self.recognize(regions, warranty_id) for regions, warranty_id in jobs]
+
+
+class EasyOcrRecognizer(Recognizer):
+    """
+    Распознавание через easyocr. Фрагменты всех скриншотов пакета обрабатываются одним вызовом readtext_batched.
+    Бинаризация применяется только к скриншотам, в которых первый проход не нашёл код гарантии
+    """
+
+    name = 'easyocr'
+    uses_easyocr = True
+
+    def _read_batch(self, crops):
+        """readtext_batched требует изображения одного размера, поэтому фрагменты дополняются цветом фона"""
+        if not crops:
+            return []
+        height = max(crop.shape[0] for crop in crops)
+        width = max(crop.shape[1] for crop in crops)
+        padded = [
+            cv2.copyMakeBorder(
+                crop, 0, height - crop.shape[0], 0, width - crop.shape[1],
+                cv2.BORDER_CONSTANT, value=int(np.median(crop[:, -1]))
+            )
+            for crop in crops
+        ]
+        results = engine.reader.readtext_batched(padded, allowlist='0123456789', detail=1)
+        return [[(text, float(confidence)) for _, text, confidence in result] for result in results]
+
+    def recognize(self, regions, warranty_id):
+        return self.recognize_batch([(regions, warranty_id)])[0]
+
+    def recognize_batch(self, jobs):
+        results = [Recognition() for _ in jobs]
+        remaining = list(range(len(jobs)))
+
+        for method in (None, 'adaptive', 'otsu'):
+            crops, owners = [], []
+            for index in remaining:
+                for region in jobs[index][0]:
+                    crops.append(region if method is None else preprocessor.binarize(region, method))
+                    owners.append(index)
+
+            passed = {index: [] for index in remaining}
+            for owner, tokens in zip(owners, self._read_batch(crops)):
+                passed[owner].extend(tokens)
+
+            for index in remaining:
+                results[index].tokens.extend(passed[index])
+                match = matcher.match(passed[index], jobs[index][1])
+                results[index].confidence = max(results[index].confidence, match.score)
+                results[index].found = match.verdict == Verdict.APPROVED
+            remaining = [index for index in remaining if not results[index].found]
+            if not remaining:
+                break
+        return results
+
+
+class DigitRecognizer(Recognizer):
+    """
+    Быстрый поиск цифр сравнением с шаблонами.
+    Символы строки выделяются как связные компоненты и сравниваются с цифрами, отрисованными шрифтами OpenCV.
+    Не требует загрузки нейросети, но надёжно работает только на чётких скриншотах
+    """
+
+    name = 'digits'
+    size = (20, 32)
+    fonts = (
+        ('FONT_HERSHEY_SIMPLEX', 2),
+        ('FONT_HERSHEY_SIMPLEX', 4),
+        ('FONT_HERSHEY_DUPLEX', 3),
+        ('FONT_HERSHEY_COMPLEX', 3),
+        ('FONT_HERSHEY_TRIPLEX', 3),
+    )
+
+    def __init__(self, min_score=None):
+        self.min_score = min_score or float(os.getenv('OCR_DIGIT_MIN_SCORE', '0.6'))
+        load_stack()
+        self.templates = self._render_templates()
+
+    def _normalize(self, glyph):
+        """Вписывает символ в прямоугольник шаблона с сохранением пропорций"""
+        width, height = self.size
+        h, w = glyph.shape[:2]
+        scale = min(width / w, height / h)
+        resized = cv2.resize(glyph, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        canvas = np.zeros((height, width), np.uint8)
+        y, x = (height - resized.shape[0]) // 2, (width - resized.shape[1]) // 2
+        canvas[y:y + resized.shape[0], x:x + resized.shape[1]] = resized
+        return canvas.astype(np.float32)
+
+    def _render_templates(self):
+        """Шаблоны цифр в виде нормированных векторов: корреляция с символом считается одним умножением матриц"""
+        digits, vectors = [], []
+        for digit in '0123456789':
+            for font, thickness in self.fonts:
+                canvas = np.zeros((80, 60), np.uint8)
+                cv2.putText(canvas, digit, (5, 65), getattr(cv2, font), 2, 255, thickness)
+                ys, xs = np.nonzero(canvas)
+                digits.append(digit)
+                vectors.append(self._vector(canvas[ys.min():ys.max() + 1, xs.min():xs.max() + 1]))
+        return digits, np.stack(vectors)
+
+    def _vector(self, glyph):
+        vector = self._normalize(glyph).flatten()
+        vector -= vector.mean()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _classify(self, glyph):
+        digits, matrix = self.templates
+        scores = matrix @ self._vector(glyph)
+        best = int(scores.argmax())
+        return digits[best], float(scores[best])
+
+    def _read_region(self, region):
+        """Возвращает последовательности цифр строки вместе со средней уверенностью"""
+        if region.mean() < 128:
+            region = cv2.bitwise_not(region)
+        binary = cv2.threshold(region, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+        count, _, stats, _ = cv2.connectedComponentsWithStats(binary)
+        glyphs = [stats[i] for i in range(1, count) if stats[i][cv2.CC_STAT_HEIGHT] >= 0.4 * region.shape[0]]
+        glyphs.sort(key=lambda g: g[cv2.CC_STAT_LEFT])
+
+        runs, digits, scores = [], "", []
+        previous_end = None
+        for x, y, w, h, _ in glyphs:
+            # Пробел между словами разрывает последовательность цифр
+            if digits and previous_end is not None and x - previous_end > 0.6 * h:
+                runs.append((digits, scores))
+                digits, scores = "", []
+            previous_end = x + w
+            digit, score = self._classify(binary[y:y + h, x:x + w])
+            if score >= self.min_score:
+                digits += digit
+                scores.append(score)
+                continue
+            if digits:
+                runs.append((digits, scores))
+            digits, scores = "", []
+        if digits:
+            runs.append((digits, scores))
+        return runs
+
+    def recognize(self, regions, warranty_id):
+        tokens = []
+        for region in regions:
+            for digits, scores in self._read_region(region):
+                tokens.append((digits, sum(scores) / len(scores)))
+                position = digits.find(warranty_id)
+                if position >= 0:
+                    matched = scores[position:position + len(warranty_id)]
+                    return Recognition(tokens, True, sum(matched) / len(matched))
+        return Recognition(tokens)
+
+
+class CascadeRecognizer(Recognizer):
+    """
+    Сначала быстрый поиск по шаблонам цифр, easyocr запускается только если по его результату гарантия не одобряется.
+    Решение принимает тот же WarrantyMatcher, что и проверка гарантии, поэтому пороги у каскада и проверки общие
+    """
+
+    name = 'cascade'
+    uses_easyocr = True
+
+    def __init__(self):
+        self.fast = DigitRecognizer()
+        self.fallback = EasyOcrRecognizer()
+
+    def recognize(self, regions, warranty_id):
+        return self.recognize_batch([(regions, warranty_id)])[0]
+
+    def recognize_batch(self, jobs):
+        results = self.fast.recognize_batch(jobs)
+        uncertain = [
+            index for index, (result, (_, warranty_id)) in enumerate(zip(results, jobs))
+            if matcher.match(result.tokens, warranty_id).verdict != Verdict.APPROVED
+        ]
+        for index, result in zip(uncertain, self.fallback.recognize_batch([jobs[index] for index in uncertain])):
+            results[index] = result
+        return results
+
+
+recognizers = {
+    EasyOcrRecognizer.name: EasyOcrRecognizer,
+    DigitRecognizer.name: DigitRecognizer,
+    CascadeRecognizer.name: CascadeRecognizer,
+}
+
+def get_recognizer(name=None) -> Recognizer:
+    name = name or os.getenv('OCR_RECOGNIZER', CascadeRecognizer.name)
+    if name not in recognizers:
+        raise ValueError(f"Неизвестный распознаватель OCR: {name}. Доступны: {', '.join(recognizers)}")
+    return recognizers[name]()
+
+recognizer: Recognizer = None
+
+
+def _init_worker():
+    global recognizer
+    load_stack()
+    recognizer = get_recognizer()
+    if recognizer.uses_easyocr:
+        engine.warm_up()
+
+def _ping():
+    return True
+
+def _run_batch(jobs):
+    """
+    Выполняется в процессе пула: предобработка и распознавание пакета скриншотов
+    :param jobs: список (байты скриншота, код гарантии, ширина скриншота или None)
+    :return: списки распознанных строк в том же порядке
+    """
+    prepared = []
+    for photo_bytes, warranty_id, width in jobs:
+        image = preprocessor.downscale(preprocessor.decode(photo_bytes, width))
+        prepared.append((preprocessor.find_regions(image) or [image], warranty_id))
+
+    results = recognizer.recognize_batch(prepared)
+    found = sum(1 for result in results if result.found)
+    logger.info(f"OCR ({recognizer.name}): пакет из {len(jobs)} скриншотов, код найден в {found}")
+    return [result.tokens for result in results]
+
+
+class CacheEntry:
+
+    def __init__(self, phash, tokens, consoles=None, files=None):
+        self.phash = phash
+        self.tokens = tokens
+        self.digits = _digits_signature(tokens)
+        self.key = f'{phash:016x}:{self.digits}'
+        self.consoles = consoles or set()
+        self.files = files or set()
+
+
+def _digits_signature(tokens):
+    """Цифры распознанных строк без учёта порядка строк. По ним отличаются скриншоты с одинаковой вёрсткой"""
+    strings = []
+    for token in tokens:
+        text = token if isinstance(token, str) else token[0]
+        digits = "".join(char for char in text if char.isdigit())
+        if digits:
+            strings.append(digits)
+    return " ".join(sorted(strings))
+
+
+class ScreenshotCache:
+    """
+    Кэш результатов распознавания скриншотов.
+    Распознанные строки берутся из кэша только для того же файла Telegram (file_unique_id).
+    Перцептивный хэш считается по уменьшенному изображению и у скриншотов с одной вёрсткой совпадает,
+    поэтому он только отбирает кандидатов: запись считается тем же скриншотом, если совпадают и цифры в распознанных строках.
+    Если задан OCR_CACHE_DB, записи сохраняются в SQLite и переживают перезапуск
+    """
+
+    def __init__(self, capacity=None, db_path=None, max_distance=None, reuse_limit=None):
+        self.capacity = capacity or int(os.getenv('OCR_CACHE_SIZE', '1000'))
+        self.max_distance = max_distance if max_distance is not None else int(os.getenv('OCR_HASH_DISTANCE', '4'))
+        self.reuse_limit = reuse_limit or int(os.getenv('OCR_REUSE_LIMIT', '3'))
+        self.db_path = db_path or os.getenv('OCR_CACHE_DB') or None
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._files = {}
+        self.db: SqliteExecutor = None
+        # Процессам пула OCR кэш не нужен: им не открываем базу и не запускаем её потоки
+        if self.db_path and multiprocessing.parent_process() is None:
+            self._open()
+
+    @staticmethod
+    def create_table(cursor: sqlite3.Cursor):
+        # В прежней схеме ключом был только хэш, и записи разных скриншотов с одной вёрсткой смешивались
+        cursor.execute('DROP TABLE IF EXISTS ocr_cache')
+        cursor.execute("""
+        CREATE TABLE ocr_cache (
+            key TEXT PRIMARY KEY,
+            phash TEXT,
+            tokens TEXT,
+            consoles TEXT,
+            files TEXT,
+            updated REAL
+        )
+        """)
+
+    migrations = [create_table]
+
+    def _open(self):
+        try:
+            self.db = SqliteExecutor.shared(self.db_path)
+            self.db.migrate(self.migrations)
+            rows = self.db.write_sync(lambda cursor: cursor.execute(
+                'SELECT phash, tokens, consoles, files FROM ocr_cache ORDER BY updated DESC LIMIT ?', (self.capacity,)
+            ).fetchall())
+            for phash, tokens, consoles, files in reversed(rows):
+                entry = CacheEntry(int(phash, 16), json.loads(tokens), set(json.loads(consoles)), set(json.loads(files)))
+                self._store(entry)
+            logger.info(f"Загружено {len(self._entries)} записей кэша OCR")
+        except Exception as e:
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nОшибка при открытии кэша OCR, кэш будет храниться только в памяти: {e}")
+            if self.db:
+                self.db.close()
+            self.db = None
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def phash(photo_bytes):
+        """Разностный хэш (dHash) 64 бита. Изображение декодируется сразу в уменьшенном в 8 раз виде"""
+        load_stack()
+        image = cv2.imdecode(np.frombuffer(photo_bytes, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+        bits = (small[:, 1:] > small[:, :-1]).flatten()
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+    def get(self, file_unique_id) -> CacheEntry:
+        """Запись для уже распознанного файла Telegram"""
+        key = self._files.get(file_unique_id)
+        if key is None:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def find(self, phash, tokens) -> CacheEntry:
+        """Запись того же скриншота: близкий хэш и те же цифры в распознанных строках"""
+        digits = _digits_signature(tokens)
+        key = f'{phash:016x}:{digits}'
+        if key not in self._entries:
+            key = next((
+                entry.key for entry in self._entries.values()
+                if entry.digits == digits and bin(entry.phash ^ phash).count('1') <= self.max_distance
+            ), None)
+        if key is None:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, phash, tokens, file_unique_id=None, console_id=None):
+        """
+        Сохраняет результат распознавания
+        :param console_id: консоль, гарантия которой одобрена по этому скриншоту. Отклонённые попытки не учитываются
+        :return: запись и признак того, что скриншот уже подтвердил гарантию OCR_REUSE_LIMIT других консолей.
+                 В этом случае консоль не запоминается
+        """
+        entry = self.find(phash, tokens) or CacheEntry(phash, tokens)
+        if file_unique_id:
+            entry.files.add(file_unique_id)
+        reused = False
+        if console_id and console_id not in entry.consoles:
+            reused = len(entry.consoles) >= self.reuse_limit
+            if not reused:
+                entry.consoles.add(console_id)
+        self._persist(entry, self._store(entry))
+        return entry, reused
+
+    def _store(self, entry: CacheEntry):
+        """:return: ключи вытесненных записей"""
+        self._entries[entry.key] = entry
+        self._entries.move_to_end(entry.key)
+        for file_unique_id in entry.files:
+            self._files[file_unique_id] = entry.key
+        evicted = []
+        while len(self._entries) > self.capacity:
+            _, oldest = self._entries.popitem(last=False)
+            for file_unique_id in oldest.files:
+                self._files.pop(file_unique_id, None)
+            evicted.append(oldest.key)
+        return evicted
+
+    def _persist(self, entry: CacheEntry, evicted):
+        """Сохраняет запись и удаляет вытесненные одной фоновой записью через очередь SqliteExecutor"""
+        if not self.db:
+            return
+        row = (entry.key, f'{entry.phash:016x}', json.dumps(entry.tokens), json.dumps(sorted(entry.consoles)), json.dumps(sorted(entry.files)), time.time())
+
+        def save(cursor: sqlite3.Cursor):
+            cursor.execute(
+                'INSERT OR REPLACE INTO ocr_cache (key, phash, tokens, consoles, files, updated) VALUES (?, ?, ?, ?, ?, ?)', row
+            )
+            cursor.executemany('DELETE FROM ocr_cache WHERE key = ?', [(key,) for key in evicted])
+
+        self.db.write_later(save)
+
+cache = ScreenshotCache()
+
+
+class OcrQueueFull(Exception):
+    pass
+
+class OcrPool:
+    """
+    Пул процессов для OCR с ограниченной очередью.
+    Распознавание не выполняется в цикле событий бота, поэтому остальные чаты не ждут окончания проверки скриншота.
+    Скриншоты, пришедшие почти одновременно, собираются в пакет (до OCR_BATCH_SIZE штук
+    или OCR_BATCH_WINDOW_MS миллисекунд ожидания) и распознаются за один проход
+    """
+
+    def __init__(self, workers=None, queue_size=None, batch_size=None, batch_window=None):
+        self.workers = workers or int(os.getenv('OCR_WORKERS', '1'))
+        self.queue_size = queue_size if queue_size is not None else int(os.getenv('OCR_QUEUE_SIZE', '20'))
+        self.batch_size = batch_size or int(os.getenv('OCR_BATCH_SIZE', '8'))
+        self.batch_window = batch_window if batch_window is not None else int(os.getenv('OCR_BATCH_WINDOW_MS', '30')) / 1000
+        self.pending = 0
+        self._executor = None
+        # Размеры пакетов, отданных процессам, в порядке отправки. Первые workers из них распознаются
+        self._in_flight: dict[asyncio.Future, int] = {}
+        self._batch = []
+        self._flush_handle = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+        return self._executor
+
+    def submit(self, photo_bytes, warranty_id, width=None):
+        """
+        Ставит скриншот в очередь на распознавание
+        :return: позиция в очереди (0 - обработка начнётся сразу) и future со списком распознанных строк
+        :raises OcrQueueFull: если очередь заполнена
+        """
+        if len(self._in_flight) < self.workers:
+            # Есть свободный процесс: скриншот уйдёт в ближайший пакет
+            waiting, position = 0, 0
+        else:
+            waiting = self.pending - sum(list(self._in_flight.values())[:self.workers])
+            position = waiting + 1
+        if waiting >= self.queue_size:
+            raise OcrQueueFull()
+        self.pending += 1
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(self._done)
+        self._batch.append(((photo_bytes, warranty_id, width), future))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return position, future
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        job = asyncio.get_running_loop().run_in_executor(self.executor, _run_batch, [job for job, _ in batch])
+        self._in_flight[job] = len(batch)
+        job.add_done_callback(lambda done: self._fan_out(done, [future for _, future in batch]))
+
+    def _fan_out(self, job: asyncio.Future, futures):
+        """Раздаёт результаты пакета ожидающим обработчикам"""
+        self._in_flight.pop(job, None)
+        if job.cancelled():
+            for future in futures:
+                future.cancel()
+            return
+        error = job.exception()
+        if isinstance(error, BrokenProcessPool):
+            logger.error(f"{inspect.currentframe().f_code.co_name} - {inspect.currentframe().f_lineno}\nПроцесс OCR аварийно завершился, пул будет пересоздан")
+            self._executor = None
+        for index, future in enumerate(futures):
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(job.result()[index])
+
+    def _done(self, future: asyncio.Future):
+        self.pending -= 1
+
+    def warm_up(self):
+        """Запускает все процессы пула, чтобы модели загрузились до первого скриншота"""
+        for _ in range(self.workers):
+            self.executor.submit(_ping)
+
+    def shutdown(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+pool = OcrPool()
@@ -0,0 +1,221 @@
+"""
+Офлайн-бенчмарк распознавания кода гарантии.
+
+Генерирует синтетические скриншоты отзывов с маркетплейса (разные шрифты, размеры, шум, качество JPEG, обрезка,
+тёмная тема) и прогоняет их через тот же конвейер, что и бот: Preprocessor -> Recognizer.
+Для каждой конфигурации выводит p50/p95 задержки, пиковый RSS, долю одобренных и отправленных на ручную проверку скриншотов.
+
+Текст рисуется через Pillow шрифтами TrueType/OpenType из системных каталогов шрифтов или из --fonts,
+а не шрифтами Hershey OpenCV, по которым DigitRecognizer строит свои шаблоны: иначе оценка первой ступени
+каскада была бы завышенной. Встроенный шрифт Pillow используется, только если других шрифтов не найдено.
+
+Примеры:
+    python ocr_bench.py --samples 50
+    python ocr_bench.py --fonts /usr/share/fonts/truetype/roboto --config recognizer=digits
+    python ocr_bench.py --config recognizer=digits,width=720 --config recognizer=cascade,regions=0
+"""
+import os
+import sys
+import re
+import json
+import time
+import random
+import resource
+import argparse
+import multiprocessing
+import ocr
+from PIL import Image, ImageDraw, ImageFont
+from database import WarrantyDb
+from re_codes import Format
+
+DEFAULT_CONFIGS = [
+    "recognizer=digits,width=1080,regions=1",
+    "recognizer=cascade,width=1080,regions=1",
+    "recognizer=easyocr,width=1080,regions=1",
+    "recognizer=easyocr,width=1080,regions=0",
+]
+
+REVIEW_LINES = [
+    "Great console, works perfectly",
+    "Delivery was fast, packaging intact",
+    "Games run smoothly, no overheating",
+    "Recommend this seller",
+    "Bought as a gift, very happy",
+]
+
+FONT_DIRS = [
+    '/usr/share/fonts',
+    '/usr/local/share/fonts',
+    os.path.expanduser('~/.fonts'),
+    os.path.expanduser('~/.local/share/fonts'),
+    '/Library/Fonts',
+    '/System/Library/Fonts',
+    os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'),
+]
+
+
+def find_fonts(paths):
+    """
+    Файлы шрифтов TrueType/OpenType в перечисленных файлах и каталогах (рекурсивно)
+    :return: отсортированный список путей. Пустая строка означает встроенный шрифт Pillow
+    """
+    fonts = set()
+    for path in paths:
+        if os.path.isfile(path):
+            fonts.add(os.path.abspath(path))
+        for root, _, files in os.walk(path):
+            fonts.update(os.path.join(root, name) for name in files if name.lower().endswith(('.ttf', '.otf')))
+    return sorted(fonts) or ['']
+
+
+def load_font(path, size):
+    return ImageFont.truetype(path, size) if path else ImageFont.load_default(size)
+
+
+def random_console_code(rng: random.Random):
+    code = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(3)) + "".join(rng.choice("0123456789") for _ in range(11))
+    assert re.fullmatch(Format.console_code, code)
+    return code
+
+
+def render_screenshot(rng: random.Random, warranty_id, font_path):
+    """Рисует скриншот отзыва: шапка, звёзды, текст отзыва с кодом гарантии в случайной строке"""
+    cv2, np = ocr.cv2, ocr.np
+    width = rng.choice([720, 1080, 1170, 1440])
+    height = int(width * rng.uniform(1.8, 2.4))
+    dark = rng.random() < 0.25
+    background, foreground = (18, 220) if dark else (255, 30)
+    image = Image.new('L', (width, height), background)
+    draw = ImageDraw.Draw(image)
+
+    scale = width / 1080
+    font = load_font(font_path, int(rng.uniform(30, 54) * scale))
+
+    draw.rectangle((0, 0, width, int(160 * scale)), fill=90 if dark else 235)
+    draw.text((int(40 * scale), int(110 * scale)), "Reviews", fill=foreground, font=load_font(font_path, int(64 * scale)), anchor='ls')
+    for star in range(5):
+        x, y, radius = int((60 + star * 70) * scale), int(260 * scale), int(25 * scale)
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=40 if dark else 200)
+
+    lines = rng.sample(REVIEW_LINES, 3)
+    lines.insert(rng.randrange(len(lines) + 1), rng.choice(["Warranty code: {}", "{}", "Code {} please"]).format(warranty_id))
+    y = int(380 * scale)
+    step = int(rng.uniform(70, 110) * scale)
+    for line in lines:
+        draw.text((int(40 * scale), y), line, fill=foreground, font=font, anchor='ls')
+        y += step
+
+    image = np.asarray(image)
+    noise = rng.uniform(0, 12)
+    if noise:
+        image = image + np.random.default_rng(rng.randrange(1 << 30)).normal(0, noise, image.shape)
+        image = np.clip(image, 0, 255).astype(np.uint8)
+
+    if rng.random() < 0.5:
+        top = rng.randrange(0, int(300 * scale))
+        bottom = rng.randrange(max(y + step, top + 1), height + 1)
+        image = image[top:bottom]
+
+    quality = rng.choice([40, 60, 75, 90])
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def build_corpus(path, samples, seed, fonts):
+    """Создаёт корпус в каталоге path или использует существующий, если он того же размера, с тем же seed и шрифтами"""
+    labels_path = os.path.join(path, 'labels.json')
+    if os.path.exists(labels_path):
+        with open(labels_path, encoding='utf-8') as f:
+            labels = json.load(f)
+        if labels.get('seed') == seed and labels.get('fonts') == fonts and len(labels['samples']) == samples:
+            return labels['samples']
+
+    ocr.load_stack()
+    os.makedirs(path, exist_ok=True)
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(samples):
+        warranty_id = WarrantyDb._get_warranty_id(random_console_code(rng))
+        font = rng.choice(fonts)
+        name = f'{index:04d}.jpg'
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(render_screenshot(rng, warranty_id, font))
+        corpus.append({'file': name, 'warranty_id': warranty_id, 'font': os.path.basename(font) or 'pillow-default'})
+
+    with open(labels_path, 'w', encoding='utf-8') as f:
+        json.dump({'seed': seed, 'fonts': fonts, 'samples': corpus}, f, ensure_ascii=False, indent=1)
+    return corpus
+
+
+def parse_config(spec):
+    config = {'recognizer': 'cascade', 'width': 1080, 'regions': 1}
+    for item in filter(None, spec.split(',')):
+        key, value = item.split('=', 1)
+        if key not in config:
+            raise ValueError(f"Неизвестный параметр конфигурации: {key}")
+        config[key] = value if key == 'recognizer' else int(value)
+    return config
+
+
+def run_config(config, path, corpus, results):
+    """Выполняется в отдельном процессе, чтобы пиковый RSS относился только к этой конфигурации"""
+    ocr.load_stack()
+    ocr.preprocessor = ocr.Preprocessor(target_width=config['width'], use_regions=bool(config['regions']))
+    ocr.recognizer = ocr.get_recognizer(config['recognizer'])
+    if ocr.recognizer.uses_easyocr:
+        ocr.engine.warm_up()
+
+    jobs = []
+    for sample in corpus:
+        with open(os.path.join(path, sample['file']), 'rb') as f:
+            jobs.append((f.read(), sample['warranty_id'], None))
+
+    # Первый прогон не учитывается: ленивые инициализации и прогрев кэшей
+    ocr._run_batch(jobs[:1])
+
+    latencies, verdicts = [], []
+    for job in jobs:
+        started = time.perf_counter()
+        tokens = ocr._run_batch([job])[0]
+        latencies.append(time.perf_counter() - started)
+        verdicts.append(ocr.matcher.match(tokens, job[1]).verdict)
+
+    latencies.sort()
+    results.put({
+        'config': config,
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'hit_rate': verdicts.count(ocr.Verdict.APPROVED) / len(jobs),
+        'manual_rate': verdicts.count(ocr.Verdict.MANUAL) / len(jobs),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк OCR на синтетических скриншотах")
+    parser.add_argument('--samples', type=int, default=100, help="количество скриншотов в корпусе")
+    parser.add_argument('--seed', type=int, default=1, help="seed генератора корпуса")
+    parser.add_argument('--corpus', default='resources/ocr_corpus', help="каталог корпуса")
+    parser.add_argument('--config', action='append', help="конфигурация вида recognizer=digits,width=1080,regions=1")
+    parser.add_argument('--fonts', action='append', help="файл или каталог шрифтов TTF/OTF, по умолчанию системные каталоги шрифтов")
+    args = parser.parse_args()
+
+    fonts = find_fonts(args.fonts or FONT_DIRS)
+    print(f"Шрифтов для корпуса: {len(fonts) if fonts[0] else 'встроенный шрифт Pillow'}")
+    corpus = build_corpus(args.corpus, args.samples, args.seed, fonts)
+    context = multiprocessing.get_context('spawn')
+    print(f"{'конфигурация':<45}{'p50, мс':>10}{'p95, мс':>10}{'RSS, МБ':>10}{'найдено':>10}{'вручную':>10}")
+    for spec in args.config or DEFAULT_CONFIGS:
+        config = parse_config(spec)
+        results = context.Queue()
+        process = context.Process(target=run_config, args=(config, args.corpus, corpus, results))
+        process.start()
+        process.join()
+        if process.exitcode:
+            print(f"{spec:<45}ошибка, код завершения {process.exitcode}")
+            continue
+        result = results.get()
+        print(f"{spec:<45}{result['p50'] * 1000:>10.1f}{result['p95'] * 1000:>10.1f}{result['rss']:>10.0f}{result['hit_rate']:>10.0%}{result['manual_rate']:>10.0%}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())